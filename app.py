@@ -1,11 +1,30 @@
+# Profilo di avvio: tempi di import e inizializzazione del primo run del processo.
+# Visibili con SPESE_PROFILO=1 (expander in fondo alla pagina e stderr).
+import profilo
+
 import streamlit as st
+profilo.segna("import streamlit")
 import pandas as pd
-import plotly.express as px
+profilo.segna("import pandas")
 from datetime import date
-from db import init_db, get_conn
+from db import init_db, warm_pool
+from service import (
+    IMMOBILI_SQL,
+    df_query, list_spese, add_immobile, delete_immobile, update_immobile,
+    mark_spesa_pagata, mark_spesa_da_pagare, delete_spesa,
+    build_piano_rows, insert_rate,
+    cashflow_buckets, cashflow_delta, separa_prima, esercizi_disponibili, n_spese_immobile,
+    versione_dati, ultima_versione_scritta,
+    euro, compute_rata_display,
+)
+profilo.segna("import service")
+from scheduler import ScadenzeScheduler
+from piano_rate import FREQUENZE, genera_piano
+profilo.segna("import scheduler, piano_rate")
 
 # --- Exit helpers imports
 import os
+import sys
 import time
 import threading
 
@@ -13,8 +32,30 @@ import threading
 # Config
 # =========================================================
 st.set_page_config(page_title="Spese Condominiali", layout="wide")
-init_db()
 TODAY = date.today()
+profilo.segna("set_page_config")
+
+def plotly_express():
+    """plotly.express viene importato solo quando si disegna un grafico."""
+    primo = "plotly.express" not in sys.modules
+    import plotly.express as px
+    if primo:
+        profilo.segna("import plotly.express")
+    return px
+
+def lazy_tabs(labels, key: str):
+    """
+    Schede con esecuzione lazy: gira solo il codice della scheda aperta.
+    Con versioni di Streamlit senza questa opzione, tutte le schede vengono eseguite.
+    """
+    try:
+        return st.tabs(labels, key=key, on_change="rerun")
+    except TypeError:
+        return st.tabs(labels)
+
+def tab_aperta(tab) -> bool:
+    aperta = getattr(tab, "open", None)
+    return True if aperta is None else bool(aperta)
 
 # =========================================================
 # Exit helpers
@@ -108,35 +149,18 @@ st.markdown(
     """,
     unsafe_allow_html=True,
 )
+profilo.segna("css")
 
 # =========================================================
 # Helpers DB
 # =========================================================
-def df_query(sql: str, params=()):
-    with get_conn() as conn:
-        return pd.read_sql_query(sql, conn, params=params)
-
-def exec_sql(sql: str, params=()):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(sql, params)
-        conn.commit()
-
-def exec_many(sql: str, seq_params):
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.executemany(sql, seq_params)
-        conn.commit()
-
 def get_immobili_df():
-    return df_query("SELECT id, nome, indirizzo, codice_fiscale, iban FROM immobili ORDER BY nome")
+    return cached_immobili_df()
 
 def get_immobile_id(nome: str) -> int:
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id FROM immobili WHERE nome=%s", (nome,))
-            row = cur.fetchone()
-            return int(row[0]) if row else None
+    imm = cached_immobili_df()
+    match = imm.loc[imm["nome"] == nome, "id"]
+    return int(match.iloc[0]) if not match.empty else None
 
 # =========================================================
 # Helpers UI/Logic
@@ -179,37 +203,274 @@ def style_font_by_status(df: pd.DataFrame, stato_col="stato", scad_col="scadenza
         return [css] * len(row)
     return df.style.apply(_apply_row, axis=1)
 
-def safe_note(base_note: str, extra: str) -> str:
-    base_note = "" if base_note is None else str(base_note).strip()
-    extra = "" if extra is None else str(extra).strip()
-    if base_note and extra:
-        return base_note + " | " + extra
-    return base_note or extra
-
-def last_n_years_available(df: pd.DataFrame, n: int = 3):
-    years = sorted(pd.to_numeric(df["esercizio"], errors="coerce").dropna().astype(int).unique().tolist())
+def last_n_years_available(years: list, n: int = 3):
+    years = sorted(years)
     if not years:
         y = TODAY.year
         return [y - 2, y - 1, y]
     return years[-n:] if len(years) >= n else years
 
-def euro(x) -> str:
-    try:
-        return f"€ {float(x):,.2f}"
-    except Exception:
-        return "€ 0,00"
+# =========================================================
+# Cache di sessione (delta in-place)
+# =========================================================
+# I DataFrame vengono letti dal DB una volta per sessione; le scritture
+# su una singola riga (pagata / da pagare / elimina / modifica immobile)
+# restituiscono la riga con RETURNING e la applicano qui, senza ricaricare.
+# Gli inserimenti massivi (Nuova spesa, nuovo immobile) invalidano la cache.
+# Le scritture di altre sessioni o della CLI vengono rilevate confrontando
+# il contatore modifiche (versione_dati, lettura per chiave primaria) al
+# massimo ogni CACHE_VERIFICA_S secondi, o con il pulsante "Aggiorna".
+# Le scritture della sessione riportano la versione che hanno prodotto:
+# se è quella attesa, le cache aggiornate a delta restano valide.
+CACHE_VERIFICA_S = float(os.environ.get("SPESE_CACHE_VERIFICA_S", "15"))
+
+def verifica_cache(forza: bool = False):
+    """Ricarica le cache di sessione se i dati nel DB sono cambiati (o se forza=True)."""
+    ora = time.monotonic()
+    if not forza and ora - st.session_state.get("_cache_verificata", 0.0) < CACHE_VERIFICA_S:
+        return
+    versione = versione_dati()
+    precedente = st.session_state.get("_cache_versione")
+    if forza or (precedente is not None and precedente != versione):
+        invalidate_spese_cache()
+        invalidate_immobili_cache()
+    st.session_state._cache_versione = versione
+    st.session_state._cache_verificata = ora
+
+def allinea_versione():
+    """
+    Dopo una scrittura della sessione già applicata a delta: se il contatore
+    è avanzato solo di questa scrittura, le cache sono allineate al DB.
+    """
+    scritta = ultima_versione_scritta()
+    attesa = st.session_state.get("_cache_versione")
+    if scritta is not None and attesa is not None and scritta == attesa + 1:
+        st.session_state._cache_versione = scritta
+
+def cached_immobili_df() -> pd.DataFrame:
+    if "_cache_immobili" not in st.session_state:
+        st.session_state._cache_immobili = df_query(IMMOBILI_SQL)
+    return st.session_state._cache_immobili
+
+def cached_esercizi() -> list:
+    """Anni con almeno una spesa (dal catalogo delle partizioni, se presenti)."""
+    if "_cache_esercizi" not in st.session_state:
+        st.session_state._cache_esercizi = esercizi_disponibili()
+    return st.session_state._cache_esercizi
+
+def cached_spese_df(anni=None) -> pd.DataFrame:
+    """
+    Spese+immobile della Dashboard con aggregati per immobile/esercizio/stato.
+    Con `anni` il filtro è nella query (solo le partizioni di quegli anni);
+    None = tutti gli esercizi. Ricaricato solo al cambio degli anni.
+    """
+    key = None if anni is None else tuple(sorted(int(a) for a in anni))
+    if "_cache_spese" not in st.session_state or st.session_state.get("_cache_spese_anni") != key:
+        df = list_spese(esercizi=key)
+        st.session_state._cache_spese = df
+        st.session_state._cache_spese_anni = key
+        st.session_state._cache_agg = build_agg(df)
+    return st.session_state._cache_spese
+
+def cached_agg(anni=None) -> dict:
+    cached_spese_df(anni)
+    return st.session_state._cache_agg
+
+def cached_pagamenti_df(filtro_immobile, filtro_stato, filtro_esercizio) -> pd.DataFrame:
+    """Elenco filtrato della scheda Pagamenti, ricaricato solo al cambio dei filtri."""
+    key = (filtro_immobile, filtro_stato, filtro_esercizio)
+    cache = st.session_state.get("_cache_pagamenti")
+    if cache is not None and cache["key"] == key:
+        return cache["df"]
+
+    df = list_spese(
+        immobile=None if filtro_immobile == "Tutti" else filtro_immobile,
+        stato=None if filtro_stato == "Tutti" else filtro_stato,
+        esercizio=None if filtro_esercizio == "Tutti" else int(filtro_esercizio),
+    )
+    st.session_state._cache_pagamenti = {"key": key, "df": df}
+    return df
+
+@st.cache_resource
+def get_scheduler() -> ScadenzeScheduler:
+    """Scheduler delle scadenze condiviso da tutte le sessioni del processo."""
+    return ScadenzeScheduler(
+        preavviso_giorni=int(os.environ.get("SPESE_PREAVVISO_GIORNI", "7")),
+        outbox_path=os.environ.get("SPESE_OUTBOX") or None,
+    )
 
-def compute_rata_display(df: pd.DataFrame) -> pd.Series:
+@st.cache_resource
+def avvia_warmup() -> threading.Thread:
     """
-    Usa SEMPRE numero_rate_totali dal DB (colonna aggiunta),
-    fallback a 1 se non valorizzato.
+    Una volta per processo, in background: init_db, connessioni del pool e
+    primo caricamento dello scheduler, così il primo render non li attende.
     """
+    scheduler = get_scheduler()
+
+    def _run():
+        try:
+            init_db()
+            warm_pool(int(os.environ.get("DB_POOL_WARM", "2")))
+            scheduler.precarica(date.today())
+        except Exception as e:
+            print(f"[warmup] {type(e).__name__}: {e}", file=sys.stderr)
+
+    t = threading.Thread(target=_run, name="spese-warmup", daemon=True)
+    t.start()
+    return t
+
+def cached_cashflow(granularita: str) -> dict:
+    """Bucket dei flussi di cassa ("month"/"week"), ricaricati solo al cambio di giorno."""
+    cache = st.session_state.get("_cache_cashflow")
+    if cache is None or cache["oggi"] != TODAY:
+        cache = {"oggi": TODAY, "buckets": {}}
+        st.session_state._cache_cashflow = cache
+    if granularita not in cache["buckets"]:
+        cache["buckets"][granularita] = cashflow_buckets(granularita, TODAY)
+    return cache["buckets"][granularita]
+
+def _ricontrolla_versione():
+    # Le cache verranno ricaricate: la versione va riletta al prossimo rerun, prima di loro.
+    st.session_state.pop("_cache_versione", None)
+    st.session_state._cache_verificata = 0.0
+
+def invalidate_spese_cache():
+    for k in ("_cache_spese", "_cache_spese_anni", "_cache_agg", "_cache_esercizi", "_cache_pagamenti", "_cache_cashflow"):
+        st.session_state.pop(k, None)
+    _ricontrolla_versione()
+
+def invalidate_immobili_cache():
+    st.session_state.pop("_cache_immobili", None)
+    _ricontrolla_versione()
+
+def _agg_key(immobile_id, esercizio, stato):
+    return (int(immobile_id), int(esercizio), str(stato))
+
+def build_agg(df: pd.DataFrame) -> dict:
+    """Somma importi per (immobile_id, esercizio, stato)."""
     if df.empty:
-        return pd.Series([], dtype="string")
-    nr = pd.to_numeric(df.get("numero_rata"), errors="coerce").fillna(1).astype(int)
-    tot = pd.to_numeric(df.get("numero_rate_totali"), errors="coerce").fillna(1).astype(int)
-    tot = tot.where(tot >= 1, 1)
-    return nr.astype(str) + "/" + tot.astype(str)
+        return {}
+    tmp = df[["immobile_id", "esercizio", "stato"]].copy()
+    tmp["importo"] = pd.to_numeric(df["importo"], errors="coerce").fillna(0)
+    tmp["esercizio"] = pd.to_numeric(tmp["esercizio"], errors="coerce")
+    tmp = tmp.dropna(subset=["esercizio"])
+    grp = tmp.groupby(["immobile_id", "esercizio", "stato"])["importo"].sum()
+    return {_agg_key(*k): float(v) for k, v in grp.items()}
+
+def _agg_delta(agg: dict, row, sign: int):
+    try:
+        key = _agg_key(row["immobile_id"], row["esercizio"], row["stato"])
+        importo = float(row["importo"] or 0)
+    except (TypeError, ValueError):
+        return
+    agg[key] = agg.get(key, 0.0) + sign * importo
+    if abs(agg[key]) < 1e-9:
+        del agg[key]
+
+def agg_to_df(agg: dict) -> pd.DataFrame:
+    return pd.DataFrame(
+        [(k[0], k[1], k[2], v) for k, v in agg.items()],
+        columns=["immobile_id", "esercizio", "stato", "importo"],
+    )
+
+def _cashflow_delta(prima, dopo):
+    cache = st.session_state.get("_cache_cashflow")
+    if cache is None:
+        return
+    for granularita, buckets in cache["buckets"].items():
+        cashflow_delta(buckets, granularita, cache["oggi"], prima, dopo)
+
+def _valore_colonna(df: pd.DataFrame, col: str, val):
+    """
+    Converte un valore di RETURNING (es. Decimal per NUMERIC) al tipo della
+    colonna in cache: pandas rifiuta un Decimal in una colonna float64.
+    """
+    if val is None or col not in df.columns:
+        return val
+    dtype = df[col].dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return bool(val)
+    if pd.api.types.is_integer_dtype(dtype):
+        return int(val)
+    if pd.api.types.is_float_dtype(dtype):
+        return float(val)
+    return val
+
+def _patch_frame(df: pd.DataFrame, row: dict, keep: bool) -> pd.DataFrame:
+    """Aggiorna (o rimuove, se keep=False) la riga con id=row['id'] nel DataFrame."""
+    mask = df["id"] == row["id"]
+    if not keep:
+        return df[~mask]
+    row = {col: _valore_colonna(df, col, val) for col, val in row.items()}
+    if mask.any():
+        idx = df.index[mask][0]
+        for col, val in row.items():
+            if col in df.columns:
+                df.at[idx, col] = val
+        return df
+    return pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+
+def _pagamenti_match(row: dict, key) -> bool:
+    filtro_immobile, filtro_stato, filtro_esercizio = key
+    if filtro_immobile != "Tutti" and row["immobile"] != filtro_immobile:
+        return False
+    if filtro_stato != "Tutti" and row["stato"] != filtro_stato:
+        return False
+    if filtro_esercizio != "Tutti" and int(row["esercizio"]) != int(filtro_esercizio):
+        return False
+    return True
+
+def apply_spesa_delta(row: dict, deleted: bool = False):
+    """
+    Applica una riga restituita da RETURNING ai DataFrame e agli aggregati in
+    cache. I valori precedenti arrivano dalla scrittura stessa (separa_prima;
+    per una DELETE la riga restituita è quella eliminata), non dalle cache.
+    """
+    if not row:
+        return
+    row, prima = separa_prima(row)
+    if deleted:
+        prima, row = row, None
+    get_scheduler().update(prima if deleted else row, deleted=deleted, versione=ultima_versione_scritta())
+    _cashflow_delta(prima, row)
+
+    sid = (prima or row)["id"]
+    if "_cache_spese" in st.session_state:
+        anni = st.session_state.get("_cache_spese_anni")
+        esercizio = int((prima or row)["esercizio"])
+        if anni is None or esercizio in anni:
+            agg = st.session_state._cache_agg
+            if prima is not None:
+                _agg_delta(agg, prima, -1)
+            if row is not None:
+                _agg_delta(agg, row, +1)
+            df = st.session_state._cache_spese
+            if row is None:
+                st.session_state._cache_spese = df[df["id"] != sid]
+            else:
+                st.session_state._cache_spese = _patch_frame(df, row, keep=True)
+
+    cache = st.session_state.get("_cache_pagamenti")
+    if cache is not None:
+        if row is None or not _pagamenti_match(row, cache["key"]):
+            cache["df"] = cache["df"][cache["df"]["id"] != sid]
+        else:
+            cache["df"] = _patch_frame(cache["df"], row, keep=True)
+    allinea_versione()
+
+def apply_immobile_delta(row: dict):
+    """Aggiorna l'immobile in cache e il nome riportato sulle righe spese collegate."""
+    if not row:
+        return
+    if "_cache_immobili" in st.session_state:
+        imm = _patch_frame(st.session_state._cache_immobili, row, keep=True)
+        st.session_state._cache_immobili = imm.sort_values("nome").reset_index(drop=True)
+    if "_cache_spese" in st.session_state:
+        df = st.session_state._cache_spese
+        df.loc[df["immobile_id"] == row["id"], "immobile"] = row["nome"]
+    # Il filtro Pagamenti è per nome: ricarica alla prossima lettura.
+    st.session_state.pop("_cache_pagamenti", None)
+    allinea_versione()
 
 # =========================================================
 # “Form versioning” for clean reset
@@ -221,8 +482,8 @@ def ns_key(name: str) -> str:
     return f"{name}__v{st.session_state.ns_form_v}"
 
 def reset_nuova_spesa():
+    st.session_state.pop(ns_key("ns_piano"), None)
     st.session_state.ns_form_v += 1
-    st.session_state["rate_items"] = []
     st.rerun()
 
 if "dash_form_v" not in st.session_state:
@@ -238,7 +499,9 @@ def reset_dashboard():
 # =========================================================
 # App UI
 # =========================================================
-st.title("Spese Condominiali")
+head = st.columns([6, 1], vertical_alignment="bottom")
+with head[0]:
+    st.title("Spese Condominiali")
 
 # Exit flow (intercetta subito al rerun)
 if st.session_state.get("_exit_requested"):
@@ -246,564 +509,670 @@ if st.session_state.get("_exit_requested"):
 #    shutdown_app(delay_seconds=1.0)
     st.stop()
 
-tabs = st.tabs(["➕ Nuova spesa", "✅ Pagamenti", "📊 Dashboard", "🏠 Immobili", "⚙️ Impostazioni"])
+with head[1]:
+    aggiorna = st.button("🔄 Aggiorna", key="refresh_btn", use_container_width=True,
+                         help="Ricarica i dati modificati da altre sessioni o dalla riga di comando")
+verifica_cache(forza=aggiorna)
+
+# Promemoria scadenze (dallo scheduler in memoria, query solo incrementali).
+# Finché il warm-up in background non ha caricato lo scheduler, il primo
+# render non lo attende: i promemoria compaiono al rerun successivo.
+warmup = avvia_warmup()
+scheduler = get_scheduler()
+if scheduler.pronto or not warmup.is_alive():
+    # advance() notifica ogni rata una sola volta per processo (outbox); ogni
+    # sessione riceve invece un solo toast riassuntivo per le rate che non ha
+    # ancora visto, così nessuna sessione resta senza avviso e non ne arrivano decine.
+    scheduler.advance(TODAY)
+    scadute = scheduler.scadute(TODAY)
+    in_scadenza = scheduler.in_scadenza(TODAY)
+    visti = st.session_state.setdefault("_promemoria_visti", set())
+    nuove_scadute = [r for r in scadute if ("scaduta", r["id"]) not in visti]
+    nuove_in_scadenza = [r for r in in_scadenza if ("in_scadenza", r["id"]) not in visti]
+    if nuove_scadute or nuove_in_scadenza:
+        parti = []
+        if nuove_scadute:
+            parti.append(f"{len(nuove_scadute)} rate scadute ({euro(sum(float(r['importo'] or 0) for r in nuove_scadute))})")
+        if nuove_in_scadenza:
+            parti.append(f"{len(nuove_in_scadenza)} in scadenza ({euro(sum(float(r['importo'] or 0) for r in nuove_in_scadenza))})")
+        st.toast("⏰ " + " — ".join(parti))
+        visti.update(("scaduta", r["id"]) for r in nuove_scadute)
+        visti.update(("in_scadenza", r["id"]) for r in nuove_in_scadenza)
+    if scadute or in_scadenza:
+        st.warning(f"⏰ Rate scadute: {len(scadute)} — in scadenza nei prossimi {scheduler.preavviso.days} giorni: {len(in_scadenza)}")
+profilo.segna("promemoria scadenze")
+
+tabs = lazy_tabs(
+    ["➕ Nuova spesa", "✅ Pagamenti", "📊 Dashboard", "📅 Flussi di cassa", "🏠 Immobili", "⚙️ Impostazioni"],
+    key="main_tabs",
+)
 
 # =========================================================
 # IMMOBILI
 # =========================================================
-with tabs[3]:
-    st.markdown('<div class="card"><div class="card-title">Immobili</div>', unsafe_allow_html=True)
-    imm = get_immobili_df()
-    if imm.empty:
-        st.info("Nessun immobile presente.")
-    else:
-        st.dataframe(
-            imm[["nome","indirizzo","codice_fiscale","iban"]].rename(columns={
-                "nome": "Immobile",
-                "indirizzo": "Indirizzo",
-                "codice_fiscale": "Codice fiscale",
-                "iban": "IBAN"
-            }),
-            use_container_width=True,
-            hide_index=True
-        )
-    st.markdown("</div>", unsafe_allow_html=True)
-
-    st.markdown('<div class="card"><div class="card-title">➕ Aggiungi immobile</div>', unsafe_allow_html=True)
-    c1, c2 = st.columns([3, 1])
-    with c1:
-        nome_new = st.text_input("Nome", placeholder="Es. Jesolo", label_visibility="collapsed", key="imm_add_name")
-    with c2:
-        if st.button("Aggiungi", key="imm_add_btn", use_container_width=True):
-            nome_new = (nome_new or "").strip()
-            if not nome_new:
-                st.warning("Inserisci un nome valido.")
-            else:
-                exec_sql("INSERT INTO immobili(nome) VALUES (%s) ON CONFLICT (nome) DO NOTHING", (nome_new,))
-                st.success("Immobile aggiunto (o già presente).")
-                st.rerun()
-    st.markdown("</div>", unsafe_allow_html=True)
+with tabs[4]:
+    if tab_aperta(tabs[4]):
+        st.markdown('<div class="card"><div class="card-title">Immobili</div>', unsafe_allow_html=True)
+        imm = get_immobili_df()
+        if imm.empty:
+            st.info("Nessun immobile presente.")
+        else:
+            st.dataframe(
+                imm[["nome","indirizzo","codice_fiscale","iban"]].rename(columns={
+                    "nome": "Immobile",
+                    "indirizzo": "Indirizzo",
+                    "codice_fiscale": "Codice fiscale",
+                    "iban": "IBAN"
+                }),
+                use_container_width=True,
+                hide_index=True
+            )
+        st.markdown("</div>", unsafe_allow_html=True)
 
-    st.markdown('<div class="card"><div class="card-title">Gestisci immobile</div>', unsafe_allow_html=True)
-    imm = get_immobili_df()
-    if imm.empty:
-        st.info("Aggiungi un immobile per gestirlo.")
+        st.markdown('<div class="card"><div class="card-title">➕ Aggiungi immobile</div>', unsafe_allow_html=True)
+        c1, c2 = st.columns([3, 1])
+        with c1:
+            nome_new = st.text_input("Nome", placeholder="Es. Jesolo", label_visibility="collapsed", key="imm_add_name")
+        with c2:
+            if st.button("Aggiungi", key="imm_add_btn", use_container_width=True):
+                nome_new = (nome_new or "").strip()
+                if not nome_new:
+                    st.warning("Inserisci un nome valido.")
+                else:
+                    add_immobile(nome_new)
+                    invalidate_immobili_cache()
+                    st.success("Immobile aggiunto (o già presente).")
+                    st.rerun()
         st.markdown("</div>", unsafe_allow_html=True)
-    else:
-        top = st.columns([3, 1, 1])
-        with top[0]:
-            scelta_nome = st.selectbox("Immobile", imm["nome"].tolist(), key="imm_sel", label_visibility="collapsed")
-
-        imm_id = get_immobile_id(scelta_nome)
-        n_spese = int(df_query("SELECT COUNT(*) AS n FROM spese WHERE immobile_id=%s", (imm_id,)).iloc[0]["n"])
-
-        if "imm_edit_mode" not in st.session_state:
-            st.session_state.imm_edit_mode = False
-            st.session_state.imm_edit_id = None
-
-        with top[1]:
-            if st.button("✏️ Modifica", key="imm_edit_btn", use_container_width=True):
-                st.session_state.imm_edit_mode = True
-                st.session_state.imm_edit_id = imm_id
-
-        with top[2]:
-            del_disabled = n_spese > 0
-            if st.button("🗑️ Elimina", key="imm_del_btn", disabled=del_disabled, use_container_width=True):
-                st.session_state.imm_confirm_delete = True
-                st.session_state.imm_delete_id = imm_id
-
-        if n_spese > 0:
-            st.caption(f"Elimina disattivato: esistono {n_spese} spese/pagamenti associati.")
-
-        if st.session_state.imm_edit_mode and st.session_state.imm_edit_id == imm_id:
-            # Valori correnti
-            row = imm[imm["id"] == imm_id].iloc[0]
-            cur_nome = row["nome"]
-            cur_indirizzo = row.get("indirizzo", "")
-            cur_cf = row.get("codice_fiscale", "")
-            cur_iban = row.get("iban", "")
-
-            st.markdown("**Modifica immobile**")
-            f1, f2 = st.columns(2)
-            with f1:
-                new_name = st.text_input("Nome", value=cur_nome or "", key="imm_edit_nome")
-                new_indirizzo = st.text_input("Indirizzo", value=cur_indirizzo or "", key="imm_edit_indirizzo")
-            with f2:
-                new_cf = st.text_input("Codice fiscale", value=cur_cf or "", key="imm_edit_cf")
-                new_iban = st.text_input("IBAN", value=cur_iban or "", key="imm_edit_iban")
-
-            a, b = st.columns([1, 1])
-            with a:
-                if st.button("Salva", key="imm_save_edit", use_container_width=True):
-                    new_name = (new_name or "").strip()
-                    new_indirizzo = (new_indirizzo or "").strip() or None
-                    new_cf = (new_cf or "").strip() or None
-                    new_iban = (new_iban or "").strip() or None
-
-                    if not new_name:
-                        st.warning("Il nome non può essere vuoto.")
-                    else:
+
+        st.markdown('<div class="card"><div class="card-title">Gestisci immobile</div>', unsafe_allow_html=True)
+        imm = get_immobili_df()
+        if imm.empty:
+            st.info("Aggiungi un immobile per gestirlo.")
+            st.markdown("</div>", unsafe_allow_html=True)
+        else:
+            top = st.columns([3, 1, 1])
+            with top[0]:
+                scelta_nome = st.selectbox("Immobile", imm["nome"].tolist(), key="imm_sel", label_visibility="collapsed")
+
+            imm_id = get_immobile_id(scelta_nome)
+            n_spese = n_spese_immobile(imm_id)
+
+            if "imm_edit_mode" not in st.session_state:
+                st.session_state.imm_edit_mode = False
+                st.session_state.imm_edit_id = None
+
+            with top[1]:
+                if st.button("✏️ Modifica", key="imm_edit_btn", use_container_width=True):
+                    st.session_state.imm_edit_mode = True
+                    st.session_state.imm_edit_id = imm_id
+
+            with top[2]:
+                del_disabled = n_spese > 0
+                if st.button("🗑️ Elimina", key="imm_del_btn", disabled=del_disabled, use_container_width=True):
+                    st.session_state.imm_confirm_delete = True
+                    st.session_state.imm_delete_id = imm_id
+
+            if n_spese > 0:
+                st.caption(f"Elimina disattivato: esistono {n_spese} spese/pagamenti associati.")
+
+            if st.session_state.imm_edit_mode and st.session_state.imm_edit_id == imm_id:
+                # Valori correnti
+                row = imm[imm["id"] == imm_id].iloc[0]
+                cur_nome = row["nome"]
+                cur_indirizzo = row.get("indirizzo", "")
+                cur_cf = row.get("codice_fiscale", "")
+                cur_iban = row.get("iban", "")
+
+                st.markdown("**Modifica immobile**")
+                f1, f2 = st.columns(2)
+                with f1:
+                    new_name = st.text_input("Nome", value=cur_nome or "", key="imm_edit_nome")
+                    new_indirizzo = st.text_input("Indirizzo", value=cur_indirizzo or "", key="imm_edit_indirizzo")
+                with f2:
+                    new_cf = st.text_input("Codice fiscale", value=cur_cf or "", key="imm_edit_cf")
+                    new_iban = st.text_input("IBAN", value=cur_iban or "", key="imm_edit_iban")
+
+                a, b = st.columns([1, 1])
+                with a:
+                    if st.button("Salva", key="imm_save_edit", use_container_width=True):
+                        new_name = (new_name or "").strip()
+                        new_indirizzo = (new_indirizzo or "").strip() or None
+                        new_cf = (new_cf or "").strip() or None
+                        new_iban = (new_iban or "").strip() or None
+
+                        if not new_name:
+                            st.warning("Il nome non può essere vuoto.")
+                        else:
+                            try:
+                                apply_immobile_delta(update_immobile(imm_id, new_name, new_indirizzo, new_cf, new_iban))
+                                st.session_state.imm_edit_mode = False
+                                st.session_state.imm_edit_id = None
+                                st.success("Immobile aggiornato.")
+                                st.rerun()
+                            except Exception as e:
+                                st.error(f"Errore aggiornamento immobile: {e}")
+                with b:
+                    if st.button("Annulla", key="imm_cancel_edit", use_container_width=True):
+                        st.session_state.imm_edit_mode = False
+                        st.session_state.imm_edit_id = None
+                        st.rerun()
+            if "imm_confirm_delete" not in st.session_state:
+                st.session_state.imm_confirm_delete = False
+                st.session_state.imm_delete_id = None
+
+            if st.session_state.imm_confirm_delete and st.session_state.imm_delete_id == imm_id:
+                st.error("Confermi l’eliminazione dell’immobile? Operazione irreversibile.")
+                a, b = st.columns(2)
+                with a:
+                    if st.button("Sì, elimina definitivamente", key="imm_del_yes"):
                         try:
-                            exec_sql(
-                                "UPDATE immobili SET nome=%s, indirizzo=%s, codice_fiscale=%s, iban=%s WHERE id=%s",
-                                (new_name, new_indirizzo, new_cf, new_iban, imm_id),
-                            )
-                            st.session_state.imm_edit_mode = False
-                            st.session_state.imm_edit_id = None
-                            st.success("Immobile aggiornato.")
+                            delete_immobile(imm_id)
+                            invalidate_immobili_cache()
+                            st.session_state.imm_confirm_delete = False
+                            st.session_state.imm_delete_id = None
+                            st.success("Immobile eliminato.")
                             st.rerun()
                         except Exception as e:
-                            st.error(f"Errore aggiornamento immobile: {e}")
-            with b:
-                if st.button("Annulla", key="imm_cancel_edit", use_container_width=True):
-                    st.session_state.imm_edit_mode = False
-                    st.session_state.imm_edit_id = None
-                    st.rerun()
-        if "imm_confirm_delete" not in st.session_state:
-            st.session_state.imm_confirm_delete = False
-            st.session_state.imm_delete_id = None
-
-        if st.session_state.imm_confirm_delete and st.session_state.imm_delete_id == imm_id:
-            st.error("Confermi l’eliminazione dell’immobile? Operazione irreversibile.")
-            a, b = st.columns(2)
-            with a:
-                if st.button("Sì, elimina definitivamente", key="imm_del_yes"):
-                    exec_sql("DELETE FROM immobili WHERE id=%s", (imm_id,))
-                    st.session_state.imm_confirm_delete = False
-                    st.session_state.imm_delete_id = None
-                    st.success("Immobile eliminato.")
-                    st.rerun()
-            with b:
-                if st.button("No, annulla", key="imm_del_no"):
-                    st.session_state.imm_confirm_delete = False
-                    st.session_state.imm_delete_id = None
-                    st.info("Operazione annullata.")
-                    st.rerun()
+                            # es. spese aggiunte nel frattempo da un'altra sessione (vincolo FK)
+                            st.session_state.imm_confirm_delete = False
+                            verifica_cache(forza=True)
+                            st.error(f"Impossibile eliminare l’immobile: {e}")
+                with b:
+                    if st.button("No, annulla", key="imm_del_no"):
+                        st.session_state.imm_confirm_delete = False
+                        st.session_state.imm_delete_id = None
+                        st.info("Operazione annullata.")
+                        st.rerun()
 
-        st.markdown("</div>", unsafe_allow_html=True)
+            st.markdown("</div>", unsafe_allow_html=True)
+    profilo.segna("scheda immobili")
 
 # =========================================================
 # NUOVA SPESA
 # =========================================================
 with tabs[0]:
-    st.markdown('<div class="card"><div class="card-title">Nuova spesa</div>', unsafe_allow_html=True)
-    imm = get_immobili_df()
-    if imm.empty:
-        st.info("Inserisci prima almeno un immobile nella scheda 🏠 Immobili.")
-        st.markdown("</div>", unsafe_allow_html=True)
-    else:
-        r1 = st.columns([2, 1, 1, 1])
-        with r1[0]:
-            nome_immobile = st.selectbox("Immobile", imm["nome"].tolist(), key=ns_key("ns_immobile"))
-        with r1[1]:
-            esercizio = st.number_input("Esercizio", min_value=2000, max_value=2100, value=TODAY.year, step=1, key=ns_key("ns_esercizio"))
-        with r1[2]:
-            tipo_spesa = st.selectbox("Tipo", ["Ordinario", "Straordinario"], index=0, key=ns_key("ns_tipo"))
-        with r1[3]:
-            tot_rates = st.number_input("N° rate", min_value=1, value=1, step=1, key=ns_key("ns_tot_rates"))
-
-        if st.session_state.get(ns_key("ns_stato"), "Da pagare") == "Pagato":
-            r2 = st.columns([1.1, 1.2, 3.7])
+    if tab_aperta(tabs[0]):
+        st.markdown('<div class="card"><div class="card-title">Nuova spesa</div>', unsafe_allow_html=True)
+        imm = get_immobili_df()
+        if imm.empty:
+            st.info("Inserisci prima almeno un immobile nella scheda 🏠 Immobili.")
+            st.markdown("</div>", unsafe_allow_html=True)
         else:
-            r2 = st.columns([1.2, 0.001, 3.8])
-        with r2[0]:
-            stato = st.selectbox("Stato", ["Da pagare", "Pagato"], index=0, key=ns_key("ns_stato"))
-        data_pagamento_all = None
-        with r2[1]:
-            if stato == "Pagato":
-                data_pagamento_all = st.date_input("Data pag.", value=TODAY, key=ns_key("ns_data_pag"))
+            # Regola del piano in un form: nessun rerun finché non si preme "Genera"
+            with st.form(key=ns_key("ns_regola"), border=False):
+                r1 = st.columns([2.4, 1, 0.8, 1.2])
+                with r1[0]:
+                    immobili_sel = st.multiselect("Immobili", imm["nome"].tolist(), default=imm["nome"].tolist()[:1], key=ns_key("ns_immobili"))
+                with r1[1]:
+                    esercizio = st.number_input("Esercizio", min_value=2000, max_value=2100, value=TODAY.year, step=1, key=ns_key("ns_esercizio"))
+                with r1[2]:
+                    n_anni = st.number_input("Anni", min_value=1, max_value=10, value=1, step=1, key=ns_key("ns_anni"))
+                with r1[3]:
+                    tipo_spesa = st.selectbox("Tipo", ["Ordinario", "Straordinario"], index=0, key=ns_key("ns_tipo"))
+
+                r2 = st.columns([1.4, 0.8, 1.2, 1.2, 1.2])
+                with r2[0]:
+                    importo_totale = st.number_input("Importo totale (€)", min_value=0.0, value=0.0, step=100.0, key=ns_key("ns_totale"))
+                with r2[1]:
+                    tot_rates = st.number_input("N° rate", min_value=1, value=1, step=1, key=ns_key("ns_tot_rates"))
+                with r2[2]:
+                    frequenza = st.selectbox("Frequenza", list(FREQUENZE), index=list(FREQUENZE).index("Trimestrale"), key=ns_key("ns_frequenza"))
+                with r2[3]:
+                    prima_scadenza = st.date_input("Prima scadenza", value=TODAY, key=ns_key("ns_prima_scad"))
+                with r2[4]:
+                    st.write("")
+                    genera = st.form_submit_button("⚙️ Genera rate", use_container_width=True)
+
+            if genera:
+                sel = imm[imm["nome"].isin(immobili_sel)]
+                piano = genera_piano(
+                    list(zip(sel["id"].astype(int), sel["nome"])),
+                    range(int(esercizio), int(esercizio) + int(n_anni)),
+                    importo_totale, int(tot_rates), prima_scadenza, frequenza, tipo_spesa,
+                )
+                piano["rata"] = compute_rata_display(piano)
+                st.session_state[ns_key("ns_piano")] = piano
+                st.session_state.ns_piano_gen = st.session_state.get("ns_piano_gen", 0) + 1
+
+            if st.session_state.get(ns_key("ns_stato"), "Da pagare") == "Pagato":
+                r3 = st.columns([1.1, 1.2, 3.7])
             else:
-                st.write("")
-        with r2[2]:
-            note_base = st.text_input("Note", placeholder="Es. gestione ordinaria 2026...", key=ns_key("ns_note"))
-
-        st.divider()
-        st.markdown('<div class="muted">Dettaglio rate</div>', unsafe_allow_html=True)
-
-        if "rate_items" not in st.session_state:
-            st.session_state.rate_items = []
-
-        while len(st.session_state.rate_items) < tot_rates:
-            st.session_state.rate_items.append({"scadenza": TODAY, "importo": 0.0})
-        while len(st.session_state.rate_items) > tot_rates:
-            st.session_state.rate_items.pop()
+                r3 = st.columns([1.2, 0.001, 3.8])
+            with r3[0]:
+                stato = st.selectbox("Stato", ["Da pagare", "Pagato"], index=0, key=ns_key("ns_stato"))
+            data_pagamento_all = None
+            with r3[1]:
+                if stato == "Pagato":
+                    data_pagamento_all = st.date_input("Data pag.", value=TODAY, key=ns_key("ns_data_pag"))
+                else:
+                    st.write("")
+            with r3[2]:
+                note_base = st.text_input("Note", placeholder="Es. gestione ordinaria 2026...", key=ns_key("ns_note"))
 
-        left, right = st.columns([3.7, 2.3], gap="small")
-        with left:
-            hdr = st.columns([0.68, 1.45, 1.45], gap="small")
-            hdr[0].caption("Rata")
-            hdr[1].caption("Scadenza")
-            hdr[2].caption("Importo (€)")
+            st.divider()
+            st.markdown('<div class="muted">Dettaglio rate (modificabili scadenza e importo)</div>', unsafe_allow_html=True)
 
+            piano = st.session_state.get(ns_key("ns_piano"))
             total_importo = 0.0
-            for i in range(tot_rates):
-                rr = st.columns([0.68, 1.45, 1.45], gap="small")
-                with rr[0]:
-                    st.markdown(f'<span class="badge">{i+1}/{tot_rates}</span>', unsafe_allow_html=True)
-                with rr[1]:
-                    scad_i = st.date_input("Scadenza", value=st.session_state.rate_items[i]["scadenza"], key=f"{ns_key('ns_scad')}_{i}", label_visibility="collapsed")
-                with rr[2]:
-                    imp_i = st.number_input("Importo (€)", min_value=0.0, value=float(st.session_state.rate_items[i]["importo"]), step=10.0, key=f"{ns_key('ns_imp')}_{i}", label_visibility="collapsed")
-                st.session_state.rate_items[i]["scadenza"] = scad_i
-                st.session_state.rate_items[i]["importo"] = float(imp_i)
-                total_importo += float(imp_i)
-
-        st.success(f"**Totale rate (somma importi): € {total_importo:,.2f}**")
+            if piano is None or piano.empty:
+                st.info("Scegli immobili, importo, rate e frequenza, poi premi «Genera rate».")
+            else:
+                piano = st.data_editor(
+                    piano,
+                    key=f"{ns_key('ns_grid')}_{st.session_state.get('ns_piano_gen', 0)}",
+                    hide_index=True,
+                    use_container_width=True,
+                    num_rows="fixed",
+                    column_order=["immobile", "esercizio", "tipo_spesa", "rata", "scadenza", "importo"],
+                    disabled=["immobile", "esercizio", "tipo_spesa", "rata"],
+                    column_config={
+                        "immobile": "Immobile",
+                        "esercizio": st.column_config.NumberColumn("Esercizio", format="%d"),
+                        "tipo_spesa": "Tipo",
+                        "rata": "Rata",
+                        "scadenza": st.column_config.DateColumn("Scadenza", format="DD/MM/YYYY", required=True),
+                        "importo": st.column_config.NumberColumn("Importo (€)", min_value=0.0, step=10.0, format="%.2f"),
+                    },
+                )
+                total_importo = float(pd.to_numeric(piano["importo"], errors="coerce").fillna(0).sum())
+
+            st.success(f"**Totale rate (somma importi): € {total_importo:,.2f}**")
 
-        st.divider()
-        btns = st.columns([1, 1, 3])
-        with btns[0]:
-            if st.button("✅ Registra", key=ns_key("ns_registra"), use_container_width=True):
-                if total_importo <= 0:
-                    st.warning("Inserisci almeno un importo maggiore di 0.")
-                else:
-                    immobile_id = get_immobile_id(nome_immobile)
-                    rows = []
-                    for i, item in enumerate(st.session_state.rate_items):
-                        importo_i = float(item["importo"])
-                        if importo_i <= 0:
-                            continue
-                        nr = i + 1
-                        extra_desc = f"{tipo_spesa} | Esercizio {int(esercizio)} | Rata {nr}/{int(tot_rates)}"
-                        note_final = safe_note(note_base, extra_desc)
-
-                        rows.append((
-                            immobile_id,
-                            int(esercizio),
-                            item["scadenza"].isoformat(),
-                            importo_i,
-                            note_final if note_final else None,
-                            stato,
-                            (data_pagamento_all.isoformat() if (stato == "Pagato" and data_pagamento_all) else None),
-                            nr,
-                            int(tot_rates),
-                            tipo_spesa
-                        ))
-
-                    if not rows:
-                        st.warning("Non ci sono rate con importo > 0 da registrare.")
+            st.divider()
+            btns = st.columns([1, 1, 3])
+            with btns[0]:
+                if st.button("✅ Registra", key=ns_key("ns_registra"), use_container_width=True):
+                    if total_importo <= 0:
+                        st.warning("Inserisci almeno un importo maggiore di 0.")
+                    elif piano["scadenza"].isna().any():
+                        st.warning("Ogni rata deve avere una scadenza.")
                     else:
-                        exec_many("""
-                            INSERT INTO spese
-                            (immobile_id, esercizio, scadenza, importo, note, stato, data_pagamento, numero_rata, numero_rate_totali, tipo_spesa)
-                            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                        """, rows)
-                        st.success(f"✅ Registrate {len(rows)} rate nel database.")
-                        reset_nuova_spesa()
-        with btns[1]:
-            if st.button("↩️ Reset", key=ns_key("ns_reset"), use_container_width=True):
-                reset_nuova_spesa()
-
-    st.markdown("</div>", unsafe_allow_html=True)
+                        rows = build_piano_rows(piano, note_base=note_base, stato=stato, data_pagamento=data_pagamento_all)
+
+                        if not rows:
+                            st.warning("Non ci sono rate con importo > 0 da registrare.")
+                        else:
+                            try:
+                                insert_rate(rows)
+                            except ValueError as e:
+                                # es. esercizio archiviato: va ripristinato prima
+                                st.error(str(e))
+                            else:
+                                invalidate_spese_cache()
+                                st.success(f"✅ Registrate {len(rows)} rate nel database.")
+                                reset_nuova_spesa()
+            with btns[1]:
+                if st.button("↩️ Reset", key=ns_key("ns_reset"), use_container_width=True):
+                    reset_nuova_spesa()
+
+        st.markdown("</div>", unsafe_allow_html=True)
+    profilo.segna("scheda nuova spesa")
 
 # =========================================================
 # PAGAMENTI
 # =========================================================
 with tabs[1]:
-    st.markdown('<div class="card"><div class="card-title">Pagamenti</div>', unsafe_allow_html=True)
+    if tab_aperta(tabs[1]):
+        st.markdown('<div class="card"><div class="card-title">Pagamenti</div>', unsafe_allow_html=True)
 
-    imm = get_immobili_df()
-    if imm.empty:
-        st.info("Inserisci prima almeno un immobile nella scheda 🏠 Immobili.")
-        st.markdown("</div>", unsafe_allow_html=True)
-    else:
-        if "pay_mark_mode" not in st.session_state:
-            st.session_state.pay_mark_mode = False
-            st.session_state.pay_mark_id = None
-
-        df_all_years = df_query("SELECT DISTINCT esercizio FROM spese ORDER BY esercizio DESC")
-        anni = [int(x) for x in pd.to_numeric(df_all_years["esercizio"], errors="coerce").dropna().tolist()] if not df_all_years.empty else []
-        anni_opt = ["Tutti"] + anni
-
-        f = st.columns([2, 1.2, 1.2])
-        with f[0]:
-            filtro_immobile = st.selectbox("Immobile", ["Tutti"] + imm["nome"].tolist(), index=0, key="pay_f_imm")
-        with f[1]:
-            filtro_stato = st.selectbox("Stato", ["Tutti", "Da pagare", "Pagato"], index=1, key="pay_f_stato")
-        with f[2]:
-            filtro_esercizio = st.selectbox("Esercizio", anni_opt, index=0, key="pay_f_esercizio")
-
-        sql = """
-            SELECT s.id, i.nome AS immobile, s.esercizio, s.numero_rata, s.numero_rate_totali, s.tipo_spesa,
-                   s.scadenza, s.importo, s.note, s.stato, s.data_pagamento
-            FROM spese s
-            JOIN immobili i ON i.id = s.immobile_id
-            WHERE 1=1
-        """
-        params = []
-        if filtro_immobile != "Tutti":
-            sql += " AND i.nome=%s"
-            params.append(filtro_immobile)
-        if filtro_stato != "Tutti":
-            sql += " AND s.stato=%s"
-            params.append(filtro_stato)
-        if filtro_esercizio != "Tutti":
-            sql += " AND s.esercizio=%s"
-            params.append(int(filtro_esercizio))
-
-        sql += " ORDER BY s.scadenza ASC, i.nome ASC, s.esercizio ASC, s.numero_rata ASC"
-        df = df_query(sql, tuple(params))
-
-        if df.empty:
-            st.info("Nessuna riga soddisfa i criteri selezionati.")
+        imm = get_immobili_df()
+        if imm.empty:
+            st.info("Inserisci prima almeno un immobile nella scheda 🏠 Immobili.")
+            st.markdown("</div>", unsafe_allow_html=True)
         else:
-            df["rata_disp"] = compute_rata_display(df)
-            df["label"] = df.apply(
-                lambda r: f"{r['immobile']} — {r['tipo_spesa']} — {int(r['esercizio']) if pd.notna(r['esercizio']) else ''} — Rata {r['rata_disp']} — Scad. {r['scadenza']} — {euro(r['importo'])}",
-                axis=1
-            )
-
-            srow = st.columns([3, 2], gap="small")
-            with srow[0]:
-                sel = st.selectbox("Seleziona rata", df["label"].tolist(), key="pay_sel", label_visibility="collapsed")
+            if "pay_mark_mode" not in st.session_state:
+                st.session_state.pay_mark_mode = False
+                st.session_state.pay_mark_id = None
 
-            row = df[df["label"] == sel].iloc[0]
-            spesa_id = int(row["id"])
-            stato_attuale = str(row["stato"])
-            scad_sel = str(row["scadenza"])
+            anni_opt = ["Tutti"] + sorted(cached_esercizi(), reverse=True)
 
-            cls = status_class(stato_attuale, scad_sel)
-            text = status_text_lower(stato_attuale, scad_sel)
+            f = st.columns([2, 1.2, 1.2])
+            with f[0]:
+                filtro_immobile = st.selectbox("Immobile", ["Tutti"] + imm["nome"].tolist(), index=0, key="pay_f_imm")
+            with f[1]:
+                filtro_stato = st.selectbox("Stato", ["Tutti", "Da pagare", "Pagato"], index=1, key="pay_f_stato")
+            with f[2]:
+                filtro_esercizio = st.selectbox("Esercizio", anni_opt, index=0, key="pay_f_esercizio")
 
-            with srow[1]:
-                st.markdown(f'<span class="statusbadge {cls}">{text}</span>', unsafe_allow_html=True)
+            df = cached_pagamenti_df(filtro_immobile, filtro_stato, filtro_esercizio).copy()
 
-            in_mark_mode = st.session_state.pay_mark_mode and st.session_state.pay_mark_id == spesa_id
-
-            action_row = st.columns([1, 1, 1, 2], gap="small")
-            with action_row[0]:
-                if st.button("✅ Pagata", key="btn_pay", use_container_width=True):
-                    st.session_state.pay_mark_mode = True
-                    st.session_state.pay_mark_id = spesa_id
-                    st.rerun()
+            if df.empty:
+                st.info("Nessuna riga soddisfa i criteri selezionati.")
+            else:
+                df["rata_disp"] = compute_rata_display(df)
+                df["label"] = df.apply(
+                    lambda r: f"{r['immobile']} — {r['tipo_spesa']} — {int(r['esercizio']) if pd.notna(r['esercizio']) else ''} — Rata {r['rata_disp']} — Scad. {r['scadenza']} — {euro(r['importo'])}",
+                    axis=1
+                )
+
+                srow = st.columns([3, 2], gap="small")
+                with srow[0]:
+                    sel = st.selectbox("Seleziona rata", df["label"].tolist(), key="pay_sel", label_visibility="collapsed")
+
+                row = df[df["label"] == sel].iloc[0]
+                spesa_id = int(row["id"])
+                stato_attuale = str(row["stato"])
+                scad_sel = str(row["scadenza"])
+
+                cls = status_class(stato_attuale, scad_sel)
+                text = status_text_lower(stato_attuale, scad_sel)
+
+                with srow[1]:
+                    st.markdown(f'<span class="statusbadge {cls}">{text}</span>', unsafe_allow_html=True)
+
+                in_mark_mode = st.session_state.pay_mark_mode and st.session_state.pay_mark_id == spesa_id
+
+                action_row = st.columns([1, 1, 1, 2], gap="small")
+                with action_row[0]:
+                    if st.button("✅ Pagata", key="btn_pay", use_container_width=True):
+                        st.session_state.pay_mark_mode = True
+                        st.session_state.pay_mark_id = spesa_id
+                        st.rerun()
 
-            if not in_mark_mode:
-                with action_row[1]:
-                    if st.button("↩️ Da pagare", key="btn_unpay", use_container_width=True):
-                        with get_conn() as c:
+                if not in_mark_mode:
+                    with action_row[1]:
+                        if st.button("↩️ Da pagare", key="btn_unpay", use_container_width=True):
                             nota_extra = st.session_state.get("pay_note", "")
-                            with c.cursor() as cur:
-                                if (nota_extra or "").strip():
-                                    cur.execute("""
-                                        UPDATE spese
-                                        SET note = CASE
-                                            WHEN note IS NULL OR trim(note) = '' THEN %s
-                                            ELSE note || ' | ' || %s
-                                        END
-                                        WHERE id = %s
-                                    """, (nota_extra.strip(), nota_extra.strip(), spesa_id))
-                                cur.execute("UPDATE spese SET stato='Da pagare', data_pagamento=NULL WHERE id=%s", (spesa_id,))
-                            c.commit()
-                        st.success("Impostata come Da pagare.")
-                        st.rerun()
+                            apply_spesa_delta(mark_spesa_da_pagare(spesa_id, nota_extra))
+                            st.success("Impostata come Da pagare.")
+                            st.rerun()
 
-                with action_row[2]:
-                    if st.button("🗑️ Elimina", key="btn_delete", use_container_width=True):
-                        st.session_state.confirm_delete_spesa = True
-                        st.session_state.pending_delete_spesa_id = spesa_id
-
-                if "confirm_delete_spesa" not in st.session_state:
-                    st.session_state.confirm_delete_spesa = False
-                    st.session_state.pending_delete_spesa_id = None
-
-                if st.session_state.confirm_delete_spesa and st.session_state.pending_delete_spesa_id == spesa_id:
-                    st.error("Confermi l’eliminazione di questa rata? Operazione irreversibile.")
-                    c1, c2 = st.columns(2)
-                    with c1:
-                        if st.button("Sì, elimina", key="confirm_del_yes", use_container_width=True):
-                            exec_sql("DELETE FROM spese WHERE id=%s", (spesa_id,))
-                            st.session_state.confirm_delete_spesa = False
-                            st.session_state.pending_delete_spesa_id = None
-                            st.success("Rata eliminata.")
+                    with action_row[2]:
+                        if st.button("🗑️ Elimina", key="btn_delete", use_container_width=True):
+                            st.session_state.confirm_delete_spesa = True
+                            st.session_state.pending_delete_spesa_id = spesa_id
+
+                    if "confirm_delete_spesa" not in st.session_state:
+                        st.session_state.confirm_delete_spesa = False
+                        st.session_state.pending_delete_spesa_id = None
+
+                    if st.session_state.confirm_delete_spesa and st.session_state.pending_delete_spesa_id == spesa_id:
+                        st.error("Confermi l’eliminazione di questa rata? Operazione irreversibile.")
+                        c1, c2 = st.columns(2)
+                        with c1:
+                            if st.button("Sì, elimina", key="confirm_del_yes", use_container_width=True):
+                                apply_spesa_delta(delete_spesa(spesa_id), deleted=True)
+                                st.session_state.confirm_delete_spesa = False
+                                st.session_state.pending_delete_spesa_id = None
+                                st.success("Rata eliminata.")
+                                st.rerun()
+                        with c2:
+                            if st.button("No, annulla", key="confirm_del_no", use_container_width=True):
+                                st.session_state.confirm_delete_spesa = False
+                                st.session_state.pending_delete_spesa_id = None
+                                st.info("Operazione annullata.")
+                                st.rerun()
+
+                if in_mark_mode:
+                    st.markdown("")
+                    dp_row = st.columns([2, 3], gap="small")
+                    with dp_row[0]:
+                        dp = st.date_input("Data pagamento", value=TODAY, key="pay_date_pick")
+                    with dp_row[1]:
+                        st.write("")
+
+                    ra = st.columns([1, 1, 3], gap="small")
+                    with ra[0]:
+                        if st.button("💾 Registra", key="pay_registra", use_container_width=True):
+                            nota_extra = st.session_state.get("pay_note", "")
+                            apply_spesa_delta(mark_spesa_pagata(spesa_id, dp, nota_extra))
+                            st.session_state.pay_mark_mode = False
+                            st.session_state.pay_mark_id = None
+                            st.success("Pagamento registrato.")
                             st.rerun()
-                    with c2:
-                        if st.button("No, annulla", key="confirm_del_no", use_container_width=True):
-                            st.session_state.confirm_delete_spesa = False
-                            st.session_state.pending_delete_spesa_id = None
-                            st.info("Operazione annullata.")
+                    with ra[1]:
+                        if st.button("❌ Annulla", key="pay_annulla", use_container_width=True):
+                            st.session_state.pay_mark_mode = False
+                            st.session_state.pay_mark_id = None
                             st.rerun()
 
-            if in_mark_mode:
-                st.markdown("")
-                dp_row = st.columns([2, 3], gap="small")
-                with dp_row[0]:
-                    dp = st.date_input("Data pagamento", value=TODAY, key="pay_date_pick")
-                with dp_row[1]:
-                    st.write("")
+                st.text_input("Nota extra", placeholder="Es. pagato con bonifico...", key="pay_note")
+
+                st.divider()
+                st.markdown('<div class="muted">Righe (ordinate per scadenza crescente)</div>', unsafe_allow_html=True)
+
+                view = df.drop(columns=["label"]).copy()
+                view["numero rata"] = compute_rata_display(view)
+                view["importo"] = view["importo"].apply(euro)
+                view = view[[
+                    "immobile",
+                    "esercizio",
+                    "tipo_spesa",
+                    "numero rata",
+                    "importo",
+                    "scadenza",
+                    "stato",
+                    "data_pagamento",
+                    "note"
+                ]]
+                st.dataframe(style_font_by_status(view, stato_col="stato", scad_col="scadenza"), use_container_width=True)
+
+                total_pay = float(pd.to_numeric(df["importo"], errors="coerce").fillna(0).sum())
+                st.success(f"**Totale righe (somma importi): € {total_pay:,.2f}**")
 
-                ra = st.columns([1, 1, 3], gap="small")
-                with ra[0]:
-                    if st.button("💾 Registra", key="pay_registra", use_container_width=True):
-                        nota_extra = st.session_state.get("pay_note", "")
-                        with get_conn() as c:
-                            with c.cursor() as cur:
-                                if (nota_extra or "").strip():
-                                    cur.execute("""
-                                        UPDATE spese
-                                        SET note = CASE
-                                            WHEN note IS NULL OR trim(note) = '' THEN %s
-                                            ELSE note || ' | ' || %s
-                                        END
-                                        WHERE id = %s
-                                    """, (nota_extra.strip(), nota_extra.strip(), spesa_id))
-                                cur.execute("UPDATE spese SET stato='Pagato', data_pagamento=%s WHERE id=%s", (dp.isoformat(), spesa_id))
-                            c.commit()
-                        st.session_state.pay_mark_mode = False
-                        st.session_state.pay_mark_id = None
-                        st.success("Pagamento registrato.")
-                        st.rerun()
-                with ra[1]:
-                    if st.button("❌ Annulla", key="pay_annulla", use_container_width=True):
-                        st.session_state.pay_mark_mode = False
-                        st.session_state.pay_mark_id = None
-                        st.rerun()
-
-            st.text_input("Nota extra", placeholder="Es. pagato con bonifico...", key="pay_note")
-
-            st.divider()
-            st.markdown('<div class="muted">Righe (ordinate per scadenza crescente)</div>', unsafe_allow_html=True)
-
-            view = df.drop(columns=["label"]).copy()
-            view["numero rata"] = compute_rata_display(view)
-            view["importo"] = view["importo"].apply(euro)
-            view = view[[
-                "immobile",
-                "esercizio",
-                "tipo_spesa",
-                "numero rata",
-                "importo",
-                "scadenza",
-                "stato",
-                "data_pagamento",
-                "note"
-            ]]
-            st.dataframe(style_font_by_status(view, stato_col="stato", scad_col="scadenza"), use_container_width=True)
-
-            total_pay = float(pd.to_numeric(df["importo"], errors="coerce").fillna(0).sum())
-            st.success(f"**Totale righe (somma importi): € {total_pay:,.2f}**")
-
-    st.markdown("</div>", unsafe_allow_html=True)
+        st.markdown("</div>", unsafe_allow_html=True)
+    profilo.segna("scheda pagamenti")
 
 # =========================================================
 # DASHBOARD
 # =========================================================
 with tabs[2]:
-    st.markdown('<div class="card"><div class="card-title">Dashboard</div>', unsafe_allow_html=True)
+    if tab_aperta(tabs[2]):
+        st.markdown('<div class="card"><div class="card-title">Dashboard</div>', unsafe_allow_html=True)
 
-    df = df_query("""
-        SELECT i.nome AS immobile, s.id, s.esercizio, s.numero_rata, s.numero_rate_totali, s.tipo_spesa,
-               s.scadenza, s.importo, s.note, s.stato, s.data_pagamento
-        FROM spese s
-        JOIN immobili i ON i.id = s.immobile_id
-    """)
+        esercizi = cached_esercizi()
+
+        if not esercizi:
+            st.info("Nessun dato nel database.")
+            st.markdown("</div>", unsafe_allow_html=True)
+        else:
+            anni_last3 = last_n_years_available(esercizi, 3)
+            imm_df = cached_immobili_df()
+
+            filters = st.columns([1.2, 2, 2], gap="small")
+            with filters[0]:
+                anno_mode = st.selectbox("Periodo", ["Ultimi 3 anni", "Tutto"], index=0, key=dash_key("dash_periodo"))
+            with filters[1]:
+                imm_sel = st.selectbox("Immobile", ["Tutti"] + sorted(imm_df["nome"].tolist()), index=0, key=dash_key("dash_imm"))
+            with filters[2]:
+                stato_sel = st.selectbox("Stato", ["Tutti", "Pagato", "Da pagare"], index=0, key=dash_key("dash_stato"))
+
+            # Il periodo filtra già in SQL (partition pruning sugli ultimi 3 anni)
+            anni_query = anni_last3 if anno_mode == "Ultimi 3 anni" else None
+            dff = cached_spese_df(anni_query).copy()
+            dff["scadenza_dt"] = pd.to_datetime(dff["scadenza"], errors="coerce")
+            dff["esercizio"] = pd.to_numeric(dff["esercizio"], errors="coerce").astype("Int64")
+            if imm_sel != "Tutti":
+                dff = dff[dff["immobile"] == imm_sel]
+            if stato_sel != "Tutti":
+                dff = dff[dff["stato"] == stato_sel]
+
+            # Totali e grafico dagli aggregati in cache (aggiornati a delta dalle scritture)
+            agg = agg_to_df(cached_agg(anni_query))
+            if imm_sel != "Tutti":
+                agg = agg[agg["immobile_id"].isin(imm_df.loc[imm_df["nome"] == imm_sel, "id"])]
+            if stato_sel != "Tutti":
+                agg = agg[agg["stato"] == stato_sel]
+
+            pagato = float(agg.loc[agg["stato"] == "Pagato", "importo"].sum())
+            da_pagare = float(agg.loc[agg["stato"] == "Da pagare", "importo"].sum())
+            totale = float(agg["importo"].sum())
+
+            k1, k2, k3 = st.columns(3)
+            k1.metric("Totale Pagato (€)", f"{pagato:,.2f}")
+            k2.metric("Totale Da pagare (€)", f"{da_pagare:,.2f}")
+            k3.metric("Totale Generale (€)", f"{totale:,.2f}")
+
+            rb = st.columns([1, 4])
+            with rb[0]:
+                if st.button("↩️ Reset", key=dash_key("dash_reset"), use_container_width=True):
+                    reset_dashboard()
+
+            st.divider()
+
+            if dff.empty:
+                st.info("Non ci sono pagamenti/spese che soddisfano i criteri selezionati.")
+            else:
+                grp = (agg.groupby("esercizio", as_index=False)["importo"].sum().sort_values("esercizio"))
+                grp["label"] = grp["importo"].map(lambda x: f"€ {float(x):,.0f}")
+
+                px = plotly_express()
+                fig = px.bar(grp, x="esercizio", y="importo", text="label")
+                fig.update_traces(textposition="outside", textfont_size=18, cliponaxis=False)
+                fig.update_layout(
+                    xaxis_title="Anno (Esercizio)",
+                    yaxis_title="Importo",
+                    xaxis=dict(
+                        type="category",
+                        tickmode="array",
+                        tickvals=grp["esercizio"].tolist(),
+                        ticktext=[str(int(y)) for y in grp["esercizio"].tolist()],
+                    ),
+                    uniformtext_minsize=16,
+                    uniformtext_mode="show",
+                )
+                st.plotly_chart(fig, use_container_width=True)
+
+            st.divider()
+            st.markdown('<div class="muted">Dettaglio righe (ordinate per scadenza crescente)</div>', unsafe_allow_html=True)
+
+            if dff.empty:
+                st.write("Nessuna riga da mostrare.")
+            else:
+                det = dff.sort_values(["scadenza_dt", "immobile", "esercizio", "numero_rata"], ascending=True).copy()
+                det["numero rata"] = compute_rata_display(det)
+                det["importo"] = det["importo"].apply(euro)
+
+                det = det[[
+                    "immobile",
+                    "esercizio",
+                    "tipo_spesa",
+                    "numero rata",
+                    "importo",
+                    "scadenza",
+                    "stato",
+                    "data_pagamento",
+                    "note"
+                ]]
+                st.dataframe(style_font_by_status(det, stato_col="stato", scad_col="scadenza"), use_container_width=True)
+
+                total_det = float(pd.to_numeric(dff["importo"], errors="coerce").fillna(0).sum())
+                st.success(f"**Totale righe (somma importi): € {total_det:,.2f}**")
 
-    if df.empty:
-        st.info("Nessun dato nel database.")
         st.markdown("</div>", unsafe_allow_html=True)
-    else:
-        df["scadenza_dt"] = pd.to_datetime(df["scadenza"], errors="coerce")
-        df["esercizio"] = pd.to_numeric(df["esercizio"], errors="coerce").astype("Int64")
-
-        anni_last3 = last_n_years_available(df, 3)
-        immobili = sorted(df["immobile"].unique().tolist())
-
-        filters = st.columns([1.2, 2, 2], gap="small")
-        with filters[0]:
-            anno_mode = st.selectbox("Periodo", ["Ultimi 3 anni", "Tutto"], index=0, key=dash_key("dash_periodo"))
-        with filters[1]:
-            imm_sel = st.selectbox("Immobile", ["Tutti"] + immobili, index=0, key=dash_key("dash_imm"))
-        with filters[2]:
-            stato_sel = st.selectbox("Stato", ["Tutti", "Pagato", "Da pagare"], index=0, key=dash_key("dash_stato"))
-
-        dff = df.copy()
-        if anno_mode == "Ultimi 3 anni":
-            dff = dff[dff["esercizio"].isin(anni_last3)]
-        if imm_sel != "Tutti":
-            dff = dff[dff["immobile"] == imm_sel]
-        if stato_sel != "Tutti":
-            dff = dff[dff["stato"] == stato_sel]
-
-        pagato = float(pd.to_numeric(dff.loc[dff["stato"] == "Pagato", "importo"], errors="coerce").fillna(0).sum())
-        da_pagare = float(pd.to_numeric(dff.loc[dff["stato"] == "Da pagare", "importo"], errors="coerce").fillna(0).sum())
-        totale = float(pd.to_numeric(dff["importo"], errors="coerce").fillna(0).sum())
-
-        k1, k2, k3 = st.columns(3)
-        k1.metric("Totale Pagato (€)", f"{pagato:,.2f}")
-        k2.metric("Totale Da pagare (€)", f"{da_pagare:,.2f}")
-        k3.metric("Totale Generale (€)", f"{totale:,.2f}")
-
-        rb = st.columns([1, 4])
-        with rb[0]:
-            if st.button("↩️ Reset", key=dash_key("dash_reset"), use_container_width=True):
-                reset_dashboard()
+    profilo.segna("scheda dashboard")
 
-        st.divider()
+# =========================================================
+# FLUSSI DI CASSA
+# =========================================================
+MESI_BREVI = ["Gen", "Feb", "Mar", "Apr", "Mag", "Giu", "Lug", "Ago", "Set", "Ott", "Nov", "Dic"]
+COLORI_CATEGORIA = {"Pagato": "#1a7f37", "Da pagare": "#d97706", "Scaduto": "#d1242f"}
 
-        if dff.empty:
-            st.info("Non ci sono pagamenti/spese che soddisfano i criteri selezionati.")
-        else:
-            grp = (dff.groupby("esercizio", as_index=False)["importo"].sum().sort_values("esercizio"))
-            grp["label"] = grp["importo"].map(lambda x: f"€ {float(x):,.0f}")
+with tabs[3]:
+    if tab_aperta(tabs[3]):
+        st.markdown('<div class="card"><div class="card-title">Flussi di cassa</div>', unsafe_allow_html=True)
+
+        fc = st.columns([1.2, 1.2, 2.6], gap="small")
+        with fc[0]:
+            raggruppa = st.selectbox("Raggruppa per", ["Mese", "Settimana"], index=0, key="cf_granularita")
+        with fc[1]:
+            anni_proiezione = st.number_input("Anni di proiezione", min_value=1, max_value=10, value=2, step=1, key="cf_anni")
+        with fc[2]:
+            categorie_sel = st.multiselect("Categorie", list(COLORI_CATEGORIA), default=list(COLORI_CATEGORIA), key="cf_categorie")
+
+        granularita = "month" if raggruppa == "Mese" else "week"
+        # Solo bucket aggregati (mai righe singole): una riga per periodo/categoria/tipo
+        cf = pd.DataFrame(
+            [(k[0], k[1], k[2], v) for k, v in cached_cashflow(granularita).items()],
+            columns=["periodo", "categoria", "tipo_spesa", "importo"],
+        )
+        cf["periodo"] = pd.to_datetime(cf["periodo"])
+        inizio = pd.Timestamp(TODAY.year - 1, 1, 1)
+        fine = pd.Timestamp(TODAY.year + int(anni_proiezione), 12, 31)
+        cf = cf[(cf["periodo"] >= inizio) & (cf["periodo"] <= fine) & (cf["categoria"].isin(categorie_sel))]
 
-            fig = px.bar(grp, x="esercizio", y="importo", text="label")
-            fig.update_traces(textposition="outside", textfont_size=18, cliponaxis=False)
+        if cf.empty:
+            st.info("Nessun flusso nel periodo selezionato.")
+        else:
+            oggi_ts = pd.Timestamp(TODAY)
+            futuro = float(cf.loc[cf["categoria"] == "Da pagare", "importo"].sum())
+            scaduto = float(cf.loc[cf["categoria"] == "Scaduto", "importo"].sum())
+            pagato_anno = float(cf.loc[(cf["categoria"] == "Pagato") & (cf["periodo"].dt.year == TODAY.year), "importo"].sum())
+
+            k1, k2, k3 = st.columns(3)
+            k1.metric("Da pagare (€)", f"{futuro:,.2f}")
+            k2.metric("Scaduto (€)", f"{scaduto:,.2f}")
+            k3.metric(f"Pagato nel {TODAY.year} (€)", f"{pagato_anno:,.2f}")
+
+            px = plotly_express()
+            fig = px.bar(
+                cf.sort_values("periodo"), x="periodo", y="importo",
+                color="categoria", pattern_shape="tipo_spesa",
+                color_discrete_map=COLORI_CATEGORIA,
+                category_orders={"categoria": list(COLORI_CATEGORIA), "tipo_spesa": ["Ordinario", "Straordinario"]},
+            )
             fig.update_layout(
-                xaxis_title="Anno (Esercizio)",
+                barmode="stack",
+                xaxis_title="Mese" if granularita == "month" else "Settimana",
                 yaxis_title="Importo",
-                xaxis=dict(
-                    type="category",
-                    tickmode="array",
-                    tickvals=grp["esercizio"].tolist(),
-                    ticktext=[str(int(y)) for y in grp["esercizio"].tolist()],
-                ),
-                uniformtext_minsize=16,
-                uniformtext_mode="show",
+                legend_title_text="",
             )
+            fig.add_vline(x=oggi_ts, line_dash="dot", line_color="#6b7280")
             st.plotly_chart(fig, use_container_width=True)
 
-        st.divider()
-        st.markdown('<div class="muted">Dettaglio righe (ordinate per scadenza crescente)</div>', unsafe_allow_html=True)
+            st.divider()
+            st.markdown('<div class="muted">Mappa mensile (anno × mese)</div>', unsafe_allow_html=True)
 
-        if dff.empty:
-            st.write("Nessuna riga da mostrare.")
-        else:
-            det = dff.sort_values(["scadenza_dt", "immobile", "esercizio", "numero_rata"], ascending=True).copy()
-            det["numero rata"] = compute_rata_display(det)
-            det["importo"] = det["importo"].apply(euro)
-
-            det = det[[
-                "immobile",
-                "esercizio",
-                "tipo_spesa",
-                "numero rata",
-                "importo",
-                "scadenza",
-                "stato",
-                "data_pagamento",
-                "note"
-            ]]
-            st.dataframe(style_font_by_status(det, stato_col="stato", scad_col="scadenza"), use_container_width=True)
-
-            total_det = float(pd.to_numeric(dff["importo"], errors="coerce").fillna(0).sum())
-            st.success(f"**Totale righe (somma importi): € {total_det:,.2f}**")
-
-    st.markdown("</div>", unsafe_allow_html=True)
+            cm = pd.DataFrame(
+                [(k[0], k[1], v) for k, v in cached_cashflow("month").items()],
+                columns=["periodo", "categoria", "importo"],
+            )
+            cm["periodo"] = pd.to_datetime(cm["periodo"])
+            cm = cm[(cm["periodo"] >= inizio) & (cm["periodo"] <= fine) & (cm["categoria"].isin(categorie_sel))]
+            heat = (
+                cm.assign(anno=cm["periodo"].dt.year, mese=cm["periodo"].dt.month)
+                .pivot_table(index="anno", columns="mese", values="importo", aggfunc="sum", fill_value=0)
+                .reindex(columns=range(1, 13), fill_value=0)
+            )
+            heat.columns = MESI_BREVI
+            heat.index = [str(a) for a in heat.index]
+            fig_h = px.imshow(
+                heat, text_auto=",.0f", aspect="auto", color_continuous_scale="Oranges",
+                labels=dict(x="Mese", y="Anno", color="Importo"),
+            )
+            st.plotly_chart(fig_h, use_container_width=True)
+
+        st.markdown("</div>", unsafe_allow_html=True)
+    profilo.segna("scheda flussi di cassa")
 
 # =========================================================
 # IMPOSTAZIONI (NEW TAB)
 # =========================================================
-with tabs[4]:
-    st.markdown('<div class="card"><div class="card-title">Impostazioni</div>', unsafe_allow_html=True)
-    st.markdown('<div class="muted">Da qui puoi chiudere l’applicazione in modo sicuro.</div>', unsafe_allow_html=True)
-    st.divider()
+with tabs[5]:
+    if tab_aperta(tabs[5]):
+        st.markdown('<div class="card"><div class="card-title">Impostazioni</div>', unsafe_allow_html=True)
+        st.markdown('<div class="muted">Da qui puoi chiudere l’applicazione in modo sicuro.</div>', unsafe_allow_html=True)
+        st.divider()
 
-    st.warning("Chiudendo l’app, tutte le sessioni verranno interrotte e la pagina non sarà più raggiungibile.")
+        st.warning("Chiudendo l’app, tutte le sessioni verranno interrotte e la pagina non sarà più raggiungibile.")
 
-    cols = st.columns([1.2, 3.8])
-    with cols[0]:
-        # Bottone "normale" (stile in linea con gli altri), non primary
-        if st.button("🚪 Exit", use_container_width=True, key="exit_btn"):
-            st.session_state["_exit_requested"] = True
-            st.rerun()
+        cols = st.columns([1.2, 3.8])
+        with cols[0]:
+            # Bottone "normale" (stile in linea con gli altri), non primary
+            if st.button("🚪 Exit", use_container_width=True, key="exit_btn"):
+                st.session_state["_exit_requested"] = True
+                st.rerun()
 
-    st.markdown("</div>", unsafe_allow_html=True)
+        st.markdown("</div>", unsafe_allow_html=True)
+    profilo.segna("scheda impostazioni")
+
+# =========================================================
+# PROFILO AVVIO (SPESE_PROFILO=1)
+# =========================================================
+profilo.segna("fine script")
+profilo.chiudi()
+if profilo.ATTIVO:
+    prof = pd.DataFrame(profilo.passi(), columns=["passo", "ms", "delta_ms"])
+    with st.expander("⏱️ Profilo avvio (primo run del processo)"):
+        st.dataframe(prof.round(1), hide_index=True, use_container_width=True)
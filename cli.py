@@ -0,0 +1,379 @@
+"""
+Riga di comando per operazioni massive e report pianificati (cron),
+senza browser. Usa service.py e non importa Streamlit né Plotly.
+
+Esempi:
+  python cli.py rate --immobile Jesolo --stato "Da pagare" --esercizio 2026
+  python cli.py paga --ids 10-14,20 --data 2026-03-01 --nota "bonifico"
+  python cli.py paga --immobile Jesolo --al 2026-06-30
+  python cli.py registra --immobile Jesolo --esercizio 2026 --rata 2026-03-31:250 --rata 2026-06-30:250
+  python cli.py piano --immobile Jesolo --immobile Milano --esercizio 2026 --anni 2 \
+      --totale 1200 --rate 4 --frequenza Trimestrale --prima-scadenza 2026-01-31 --conferma
+  python cli.py esporta spese.csv --esercizio 2026
+  python cli.py scadenze --giorni 15
+  python cli.py flussi --settimane --dal 2026-01-01 --al 2026-12-31
+  python cli.py promemoria --outbox promemoria.jsonl --loop
+  python cli.py partizioni migra
+  python cli.py partizioni archivia 2018 --compatta
+"""
+import argparse
+import sys
+from datetime import date
+
+import pandas as pd
+
+import service
+import partitioning
+from db import ensure_indexes, ensure_modifiche, get_conn
+from piano_rate import FREQUENZE, genera_piano
+from scheduler import ScadenzeScheduler
+
+
+def parse_date(value: str) -> date:
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"data non valida (atteso AAAA-MM-GG): {value}")
+
+
+def parse_ids(value: str) -> list:
+    """'3,7-10' -> [3, 7, 8, 9, 10]"""
+    ids = []
+    try:
+        for part in value.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            if "-" in part:
+                a, b = (int(x) for x in part.split("-", 1))
+                if a > b:
+                    raise argparse.ArgumentTypeError(f"intervallo di id invertito: {part} (usa {b}-{a})")
+                ids.extend(range(a, b + 1))
+            else:
+                ids.append(int(part))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"elenco id non valido: {value}")
+    if not ids:
+        raise argparse.ArgumentTypeError(f"elenco id vuoto: {value!r}")
+    return ids
+
+
+def parse_rata(value: str):
+    """'2026-03-31:250' -> (date(2026, 3, 31), 250.0)"""
+    try:
+        scad, imp = value.rsplit(":", 1)
+        return date.fromisoformat(scad), float(imp)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"rata non valida (atteso AAAA-MM-GG:IMPORTO): {value}")
+
+
+def add_filter_args(p, stato_default=None):
+    p.add_argument("--immobile", help="nome immobile")
+    p.add_argument("--stato", choices=service.STATI, default=stato_default)
+    p.add_argument("--esercizio", type=int)
+    p.add_argument("--ids", type=parse_ids, help="id rate, es. 3,7-10")
+    p.add_argument("--dal", type=parse_date, help="scadenza da (inclusa)")
+    p.add_argument("--al", type=parse_date, help="scadenza fino a (inclusa)")
+
+
+def filters_from_args(args) -> dict:
+    return {
+        "immobile": args.immobile,
+        "stato": args.stato,
+        "esercizio": args.esercizio,
+        "ids": args.ids,
+        "scadenza_dal": args.dal,
+        "scadenza_al": args.al,
+    }
+
+
+def print_df(df, columns=None):
+    if df.empty:
+        print("Nessuna riga.")
+        return
+    if columns:
+        df = df[columns]
+    print(df.to_string(index=False))
+
+
+# =========================================================
+# Comandi
+# =========================================================
+def cmd_immobili(args):
+    print_df(service.get_immobili_df(), ["id", "nome", "indirizzo", "codice_fiscale", "iban"])
+    return 0
+
+
+def cmd_rate(args):
+    df = service.list_spese(**filters_from_args(args))
+    if not df.empty:
+        df["rata"] = service.compute_rata_display(df)
+    print_df(df, ["id", "immobile", "esercizio", "tipo_spesa", "rata", "scadenza", "importo", "stato", "data_pagamento"])
+    if not df.empty:
+        totale = float(pd.to_numeric(df["importo"], errors="coerce").fillna(0).sum())
+        print(f"\n{len(df)} rate, totale {service.euro(totale)}")
+    return 0
+
+
+def cmd_paga(args):
+    filtri = filters_from_args(args)
+    if not any(v is not None for k, v in filtri.items() if k != "stato"):
+        print("Specifica almeno un filtro (--ids, --immobile, --esercizio, --dal, --al).", file=sys.stderr)
+        return 2
+    if args.dry_run:
+        df = service.list_spese(**filtri)
+        print_df(df, ["id", "immobile", "esercizio", "scadenza", "importo"])
+        print(f"\n{len(df)} rate verrebbero segnate come pagate.")
+        return 0
+    rows = service.mark_spese_pagate(args.data, args.nota, **filtri)
+    totale = sum(float(r["importo"] or 0) for r in rows)
+    print(f"Segnate come pagate {len(rows)} rate ({service.euro(totale)}).")
+    return 0
+
+
+def cmd_registra(args):
+    immobile_id = service.get_immobile_id(args.immobile)
+    if immobile_id is None:
+        print(f"Immobile non trovato: {args.immobile}", file=sys.stderr)
+        return 1
+    rows = service.build_rate_rows(
+        immobile_id, args.esercizio, args.tipo, args.rata,
+        note_base=args.note, stato=args.stato, data_pagamento=args.data_pagamento,
+    )
+    if not rows:
+        print("Non ci sono rate con importo > 0 da registrare.", file=sys.stderr)
+        return 1
+    service.insert_rate(rows)
+    print(f"Registrate {len(rows)} rate.")
+    return 0
+
+
+def cmd_piano(args):
+    imm = service.get_immobili_df()
+    if not args.tutti:
+        mancanti = sorted(set(args.immobile or []) - set(imm["nome"]))
+        if mancanti or not args.immobile:
+            print(f"Immobili non trovati: {', '.join(mancanti)}" if mancanti else "Specifica --immobile o --tutti.", file=sys.stderr)
+            return 1
+        imm = imm[imm["nome"].isin(args.immobile)]
+    piano = genera_piano(
+        list(zip(imm["id"].astype(int), imm["nome"])),
+        range(args.esercizio, args.esercizio + args.anni),
+        args.totale, args.rate, args.prima_scadenza, args.frequenza, args.tipo,
+    )
+    piano["rata"] = service.compute_rata_display(piano)
+    print_df(piano, ["immobile", "esercizio", "tipo_spesa", "rata", "scadenza", "importo"])
+    if not args.conferma:
+        print(f"\n{len(piano)} rate generate (anteprima: aggiungi --conferma per registrarle).")
+        return 0
+    rows = service.build_piano_rows(piano, note_base=args.note)
+    service.insert_rate(rows)
+    print(f"\nRegistrate {len(rows)} rate.")
+    return 0
+
+
+def cmd_esporta(args):
+    df = service.list_spese(**filters_from_args(args))
+    if args.output.lower().endswith(".xlsx"):
+        try:
+            df.to_excel(args.output, index=False)
+        except ImportError:
+            print("L'esportazione .xlsx richiede openpyxl (pip install openpyxl); in alternativa usa un file .csv.",
+                  file=sys.stderr)
+            return 1
+    else:
+        df.to_csv(args.output, index=False)
+    print(f"Esportate {len(df)} righe in {args.output}.")
+    return 0
+
+
+def cmd_scadenze(args):
+    df = service.riepilogo_scadenze(args.oggi, args.giorni)
+    if df.empty:
+        print("Nessuna rata scaduta o in scadenza.")
+        return 0
+    print_df(df)
+    n_scadute = int(df["n_scadute"].sum())
+    print(
+        f"\nScadute: {n_scadute} ({service.euro(df['importo_scadute'].astype(float).sum())}) — "
+        f"in scadenza entro {args.giorni} giorni: {int(df['n_in_scadenza'].sum())} "
+        f"({service.euro(df['importo_in_scadenza'].astype(float).sum())})"
+    )
+    # Exit code 3 se ci sono rate scadute: utile per notifiche da cron.
+    return 3 if (args.exit_code and n_scadute) else 0
+
+
+def cmd_flussi(args):
+    granularita = "week" if args.settimane else "month"
+    df = pd.DataFrame(
+        [(k[0], k[1], v) for k, v in service.cashflow_buckets(granularita, args.oggi).items()],
+        columns=["periodo", "categoria", "importo"],
+    )
+    if args.dal:
+        df = df[df["periodo"] >= args.dal]
+    if args.al:
+        df = df[df["periodo"] <= args.al]
+    if df.empty:
+        print("Nessun flusso nel periodo.")
+        return 0
+    tab = df.pivot_table(index="periodo", columns="categoria", values="importo", aggfunc="sum", fill_value=0)
+    tab = tab.reindex(columns=service.CATEGORIE_CASSA, fill_value=0)
+    tab["Totale"] = tab.sum(axis=1)
+    print(tab.round(2).to_string())
+    return 0
+
+
+def cmd_promemoria(args):
+    scheduler = ScadenzeScheduler(
+        preavviso_giorni=args.preavviso,
+        orizzonte_giorni=max(args.orizzonte, args.preavviso),
+        outbox_path=args.outbox,
+    )
+
+    def stampa(promemoria):
+        for p in promemoria:
+            print(f"[{p['tipo']}] {p['immobile']} — {p['esercizio']} — rata {p['numero_rata']}/{p['numero_rate_totali']} "
+                  f"— scad. {p['scadenza']} — {service.euro(p['importo'])}")
+
+    if args.loop:
+        scheduler.run_forever(args.intervallo, on_promemoria=stampa)
+        return 0
+    promemoria = scheduler.advance(args.oggi)
+    stampa(promemoria)
+    print(f"{len(promemoria)} nuovi promemoria.")
+    return 0
+
+
+def cmd_indici(args):
+    ensure_indexes()
+    ensure_modifiche()
+    print("Indici e contatore modifiche verificati.")
+    return 0
+
+
+def cmd_partizioni(args):
+    if args.azione == "elenco":
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                if not partitioning.is_partizionata(cur):
+                    print("La tabella spese non è partizionata (usa: partizioni migra).")
+                    return 0
+                for nome, righe in partitioning.elenco_partizioni(cur):
+                    print(f"{nome}\t~{max(int(righe), 0)} righe")
+        return 0
+    if args.azione == "migra":
+        anni = partitioning.migra_spese(elimina_vecchia=args.elimina_vecchia)
+        print(f"Migrazione completata: {len(anni)} partizioni per esercizio." if anni else "Tabella spese già partizionata.")
+        return 0
+
+    if args.anno is None:
+        print(f"Specifica l'anno per '{args.azione}'.", file=sys.stderr)
+        return 2
+    if args.azione == "crea":
+        if not partitioning.ensure_partizioni([args.anno]):
+            print("La tabella spese non è partizionata (usa: partizioni migra).", file=sys.stderr)
+            return 1
+        print(f"Partizione {partitioning.nome_partizione(args.anno)} pronta.")
+    elif args.azione == "archivia":
+        partitioning.archivia_esercizio(args.anno, compatta=args.compatta)
+        print(f"Esercizio {args.anno} archiviato nello schema {partitioning.SCHEMA_ARCHIVIO}.")
+    elif args.azione == "ripristina":
+        partitioning.ripristina_esercizio(args.anno)
+        print(f"Esercizio {args.anno} ripristinato.")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="spese", description="Spese Condominiali — riga di comando")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("immobili", help="elenco immobili")
+    p.set_defaults(func=cmd_immobili)
+
+    p = sub.add_parser("rate", help="elenco rate filtrate")
+    add_filter_args(p)
+    p.set_defaults(func=cmd_rate)
+
+    p = sub.add_parser("paga", help="segna come pagate le rate filtrate")
+    add_filter_args(p, stato_default="Da pagare")
+    p.add_argument("--data", type=parse_date, default=date.today(), help="data pagamento (default: oggi)")
+    p.add_argument("--nota", default="", help="nota extra da accodare")
+    p.add_argument("--dry-run", action="store_true", help="mostra le rate senza modificarle")
+    p.set_defaults(func=cmd_paga)
+
+    p = sub.add_parser("registra", help="registra un piano rate")
+    p.add_argument("--immobile", required=True)
+    p.add_argument("--esercizio", type=int, required=True)
+    p.add_argument("--tipo", choices=service.TIPI_SPESA, default="Ordinario")
+    p.add_argument("--rata", type=parse_rata, action="append", required=True, help="AAAA-MM-GG:IMPORTO (ripetibile)")
+    p.add_argument("--note", default="")
+    p.add_argument("--stato", choices=service.STATI, default="Da pagare")
+    p.add_argument("--data-pagamento", type=parse_date)
+    p.set_defaults(func=cmd_registra)
+
+    p = sub.add_parser("piano", help="genera (e registra) un piano rate per più immobili ed esercizi")
+    p.add_argument("--immobile", action="append", help="nome immobile (ripetibile)")
+    p.add_argument("--tutti", action="store_true", help="tutti gli immobili")
+    p.add_argument("--esercizio", type=int, required=True, help="primo esercizio")
+    p.add_argument("--anni", type=int, default=1, help="numero di esercizi consecutivi")
+    p.add_argument("--totale", type=float, required=True, help="importo totale per immobile ed esercizio")
+    p.add_argument("--rate", type=int, required=True, help="numero di rate")
+    p.add_argument("--frequenza", choices=list(FREQUENZE), default="Trimestrale")
+    p.add_argument("--prima-scadenza", type=parse_date, required=True)
+    p.add_argument("--tipo", choices=service.TIPI_SPESA, default="Ordinario")
+    p.add_argument("--note", default="")
+    p.add_argument("--conferma", action="store_true", help="registra le rate (senza: solo anteprima)")
+    p.set_defaults(func=cmd_piano)
+
+    p = sub.add_parser("esporta", help="esporta le rate filtrate in CSV o XLSX")
+    p.add_argument("output", help="file di destinazione (.csv o .xlsx)")
+    add_filter_args(p)
+    p.set_defaults(func=cmd_esporta)
+
+    p = sub.add_parser("scadenze", help="riepilogo rate scadute e in scadenza")
+    p.add_argument("--giorni", type=int, default=30)
+    p.add_argument("--oggi", type=parse_date, default=date.today())
+    p.add_argument("--exit-code", action="store_true", help="esce con codice 3 se ci sono rate scadute")
+    p.set_defaults(func=cmd_scadenze)
+
+    p = sub.add_parser("flussi", help="flussi di cassa per mese (o settimana) e categoria")
+    p.add_argument("--settimane", action="store_true", help="raggruppa per settimana invece che per mese")
+    p.add_argument("--dal", type=parse_date)
+    p.add_argument("--al", type=parse_date)
+    p.add_argument("--oggi", type=parse_date, default=date.today())
+    p.set_defaults(func=cmd_flussi)
+
+    p = sub.add_parser("promemoria", help="promemoria rate in scadenza/scadute (outbox JSON lines)")
+    p.add_argument("--outbox", help="file outbox (JSON lines); evita anche i doppi invii tra esecuzioni")
+    p.add_argument("--preavviso", type=int, default=7, help="giorni di preavviso")
+    p.add_argument("--orizzonte", type=int, default=60, help="giorni caricati in memoria")
+    p.add_argument("--oggi", type=parse_date, default=date.today())
+    p.add_argument("--loop", action="store_true", help="resta attivo e controlla periodicamente")
+    p.add_argument("--intervallo", type=float, default=3600.0, help="secondi tra i controlli con --loop")
+    p.set_defaults(func=cmd_promemoria)
+
+    p = sub.add_parser("partizioni", help="partizionamento di spese per esercizio")
+    p.add_argument("azione", choices=["elenco", "migra", "crea", "archivia", "ripristina"])
+    p.add_argument("anno", type=int, nargs="?", help="esercizio (per crea/archivia/ripristina)")
+    p.add_argument("--elimina-vecchia", action="store_true", help="con migra: elimina la tabella originale")
+    p.add_argument("--compatta", action="store_true", help="con archivia: VACUUM FULL della partizione archiviata")
+    p.set_defaults(func=cmd_partizioni)
+
+    p = sub.add_parser("indici", help="crea gli indici delle query a range e il contatore modifiche")
+    p.set_defaults(func=cmd_indici)
+
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except ValueError as e:
+        # errori di dominio (es. esercizio archiviato, migrazione non possibile)
+        print(f"Errore: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
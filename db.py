@@ -1,10 +1,15 @@
 import os
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.extensions
 
 
-def get_conn():
+def connect():
     """
-    Connessione PostgreSQL (Supabase) tramite variabili d'ambiente.
+    Nuova connessione PostgreSQL (Supabase) tramite variabili d'ambiente.
 
     Richiede:
       DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD
@@ -21,9 +26,159 @@ def get_conn():
     )
 
 
+# =========================================================
+# Pool di connessioni (per processo)
+# =========================================================
+# Le connessioni inattive vengono riusate invece di aprirne una nuova (con
+# handshake TLS verso Supabase) a ogni query. Il pool non blocca mai: oltre
+# DB_POOL_MAX connessioni inattive, quelle in più vengono chiuse al rilascio.
+# Una connessione rimasta inattiva più di DB_POOL_VERIFICA_S secondi viene
+# verificata con SELECT 1 prima del riuso: se il server o il pooler l'ha
+# chiusa nel frattempo viene scartata e se ne apre una nuova (con
+# DB_POOL_VERIFICA_S=0 la verifica si fa a ogni riuso).
+_pool_lock = threading.Lock()
+_pool_idle = []  # (connessione, istante del rilascio)
+
+
+def _pool_max() -> int:
+    return int(os.environ.get("DB_POOL_MAX", "5"))
+
+
+def _pool_verifica_s() -> float:
+    return float(os.environ.get("DB_POOL_VERIFICA_S", "5"))
+
+
+def _viva(conn) -> bool:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        conn.close()
+        return False
+
+
+def _acquire():
+    while True:
+        with _pool_lock:
+            if not _pool_idle:
+                break
+            conn, rilascio = _pool_idle.pop()
+        if conn.closed:
+            continue
+        if time.monotonic() - rilascio < _pool_verifica_s() or _viva(conn):
+            return conn
+    return connect()
+
+
+def _release(conn):
+    if conn.closed:
+        return
+    try:
+        if conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            raise psycopg2.InterfaceError("connessione in stato sconosciuto")
+        if conn.autocommit:
+            conn.autocommit = False
+    except psycopg2.Error:
+        conn.close()
+        return
+    with _pool_lock:
+        if len(_pool_idle) < _pool_max():
+            _pool_idle.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+
+@contextmanager
+def get_conn():
+    """
+    Connessione dal pool, da usare come `with get_conn() as conn:`.
+    All'uscita la transazione viene confermata (o annullata in caso di
+    eccezione) e la connessione torna nel pool; se nel frattempo è
+    caduta viene scartata.
+    """
+    conn = _acquire()
+    try:
+        with conn:
+            yield conn
+    finally:
+        _release(conn)
+
+
+def warm_pool(n: int = 1):
+    """Apre in anticipo fino a n connessioni inattive (es. in background all'avvio)."""
+    nuove = []
+    with _pool_lock:
+        mancanti = min(n, _pool_max()) - len(_pool_idle)
+    for _ in range(max(mancanti, 0)):
+        nuove.append(connect())
+    for conn in nuove:
+        _release(conn)
+
+
 def init_db():
     """
     Su Supabase lo schema è già creato e i dati sono già migrati,
     quindi qui non facciamo CREATE TABLE.
     """
     return
+
+
+def ensure_indexes():
+    """
+    Indici usati dalle query a range (idempotente, sicuro da rilanciare).
+
+    - idx_spese_da_pagare_scadenza: indice parziale sulle sole rate da pagare,
+      usato dallo scheduler delle scadenze per i caricamenti incrementali.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_spese_da_pagare_scadenza "
+                "ON spese (scadenza, id) WHERE stato = 'Da pagare'"
+            )
+        conn.commit()
+
+
+# =========================================================
+# Contatore modifiche
+# =========================================================
+# Ogni istruzione su spese o immobili (app, CLI, altri processi) incrementa
+# modifiche.versione con un trigger per istruzione: le sessioni confrontano
+# un solo valore (lettura per chiave primaria) invece di riaggregare le tabelle.
+MODIFICHE_TABELLE = ("spese", "immobili")
+
+MODIFICHE_SQL = """
+CREATE TABLE IF NOT EXISTS modifiche (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    versione BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO modifiche (id) VALUES (1) ON CONFLICT (id) DO NOTHING;
+CREATE OR REPLACE FUNCTION conta_modifica() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE modifiche SET versione = versione + 1 WHERE id = 1;
+    RETURN NULL;
+END
+$$;
+"""
+
+MODIFICHE_TRIGGER_SQL = (
+    "CREATE OR REPLACE TRIGGER {tabella}_modifiche "
+    "AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {tabella} "
+    "FOR EACH STATEMENT EXECUTE FUNCTION conta_modifica()"
+)
+
+
+def crea_trigger_modifiche(cur, tabella: str):
+    cur.execute(MODIFICHE_TRIGGER_SQL.format(tabella=tabella))
+
+
+def ensure_modifiche():
+    """Tabella modifiche e trigger su spese e immobili (idempotente, PostgreSQL 14+)."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(MODIFICHE_SQL)
+            for tabella in MODIFICHE_TABELLE:
+                crea_trigger_modifiche(cur, tabella)
+        conn.commit()
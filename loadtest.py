@@ -0,0 +1,792 @@
+"""
+Load test di app.py su un server Streamlit reale e un PostgreSQL locale usa-e-getta.
+
+Per ogni livello di carico il test avvia `streamlit run app.py` (headless, su una
+porta libera) contro il database di prova e collega N client websocket a
+/_stcore/stream, come N schede del browser: ogni client invia le BackMsg
+rerun_script con gli stati dei widget e legge i ForwardMsg fino alla fine dello
+script. Le sessioni ripetono in parallelo un percorso utente scritto:
+
+  apertura -> filtra Pagamenti -> segna pagata -> Dashboard -> aggiungi immobile
+
+Un'interazione è un errore se lo script termina con un'eccezione, se un widget
+atteso non compare, se la connessione cade o se scade il timeout.
+
+Report: latenza per interazione (p50/p95/p99), connessioni DB aperte (totali e
+picco contemporaneo), query per interazione e CPU/memoria del processo server
+(da /proc/<pid>). Connessioni e query sono contate dentro il server: il processo
+avviato dal test sostituisce db.connect con una versione che conta connessioni
+ed execute e scrive i totali in un file mappato in memoria letto dal test.
+Con --avvio N misura anche il primo render a freddo: N server nuovi
+(`python -m streamlit run`, senza strumentazione), dal lancio del processo alla
+fine del primo script, con il profilo di avvio di app.py (SPESE_PROFILO=1).
+Con --app si misura un altro app.py (es. il checkout di una versione precedente).
+
+Il database è un cluster PostgreSQL temporaneo (initdb + pg_ctl, cercati nel PATH,
+in PG_BIN o con pg_config --bindir) creato, popolato e distrutto dal test.
+Con --esterno si usa invece un database di prova indicato dalle variabili
+LOADTEST_DB_HOST, LOADTEST_DB_PORT, LOADTEST_DB_NAME, LOADTEST_DB_USER,
+LOADTEST_DB_PASSWORD (e LOADTEST_DB_SSLMODE): il test ne ELIMINA le tabelle
+spese e immobili. Le variabili DB_* dell'app non vengono mai usate per questo
+e il test si rifiuta di partire se i due database coincidono.
+
+Esempi:
+  python loadtest.py --sessioni 10 --iterazioni 5
+  python loadtest.py --sessioni 1,5,20 --immobili 50 --anni 5 --json risultati.json
+  python loadtest.py --sessioni 1 --avvio 5
+  python loadtest.py --sessioni 0 --avvio 5 --app /tmp/versione-precedente/app.py
+"""
+import argparse
+import json
+import mmap
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# application_name delle connessioni del server (PGAPPNAME): il picco di
+# connessioni conta solo quelle, non quelle del test.
+APP_NAME_SERVER = "spese-loadtest"
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS immobili (
+    id SERIAL PRIMARY KEY,
+    nome TEXT NOT NULL UNIQUE,
+    indirizzo TEXT,
+    codice_fiscale TEXT,
+    iban TEXT
+);
+CREATE TABLE IF NOT EXISTS spese (
+    id SERIAL PRIMARY KEY,
+    immobile_id INTEGER NOT NULL REFERENCES immobili(id),
+    esercizio INTEGER NOT NULL,
+    scadenza DATE,
+    importo NUMERIC(12, 2) NOT NULL,
+    note TEXT,
+    stato TEXT NOT NULL DEFAULT 'Da pagare',
+    data_pagamento DATE,
+    numero_rata INTEGER,
+    numero_rate_totali INTEGER,
+    tipo_spesa TEXT
+);
+"""
+
+SEED_SQL = """
+INSERT INTO immobili (nome, indirizzo)
+SELECT 'Immobile ' || lpad(g::text, 4, '0'), 'Via Prova ' || g
+FROM generate_series(1, %(immobili)s) g;
+
+INSERT INTO spese (immobile_id, esercizio, scadenza, importo, note, stato, data_pagamento,
+                   numero_rata, numero_rate_totali, tipo_spesa)
+SELECT i.id, a.anno,
+       make_date(a.anno, 1 + (r.n - 1) * (12 / %(rate)s), 28),
+       round((200 + random() * 800)::numeric, 2),
+       NULL,
+       CASE WHEN make_date(a.anno, 1 + (r.n - 1) * (12 / %(rate)s), 28) < current_date AND random() < 0.8
+            THEN 'Pagato' ELSE 'Da pagare' END,
+       NULL,
+       r.n, %(rate)s,
+       CASE WHEN random() < 0.85 THEN 'Ordinario' ELSE 'Straordinario' END
+FROM immobili i
+CROSS JOIN generate_series(extract(year FROM current_date)::int - %(anni)s + 1,
+                           extract(year FROM current_date)::int) AS a(anno)
+CROSS JOIN generate_series(1, %(rate)s) AS r(n);
+
+UPDATE spese SET data_pagamento = scadenza WHERE stato = 'Pagato';
+"""
+
+
+# =========================================================
+# PostgreSQL locale usa-e-getta
+# =========================================================
+def _pg_bindir() -> str:
+    if os.environ.get("PG_BIN"):
+        return os.environ["PG_BIN"]
+    found = shutil.which("initdb")
+    if found:
+        return os.path.dirname(found)
+    try:
+        return subprocess.check_output(["pg_config", "--bindir"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        raise SystemExit("PostgreSQL non trovato: installa il server (initdb/pg_ctl) o imposta PG_BIN.")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalPostgres:
+    """Cluster PostgreSQL temporaneo; imposta le variabili DB_* lette da db.connect()."""
+
+    def __init__(self):
+        if hasattr(os, "geteuid") and os.geteuid() == 0:
+            raise SystemExit("initdb non può girare come root: usa un utente normale oppure --esterno (LOADTEST_DB_*).")
+        self.bindir = _pg_bindir()
+        self.port = _free_port()
+        self.datadir = None
+
+    def __enter__(self):
+        self.datadir = tempfile.mkdtemp(prefix="spese-loadtest-")
+        pgdata = os.path.join(self.datadir, "data")
+        subprocess.run(
+            [os.path.join(self.bindir, "initdb"), "-D", pgdata, "-U", "postgres", "-A", "trust", "--no-sync"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        subprocess.run(
+            [os.path.join(self.bindir, "pg_ctl"), "-D", pgdata, "-w", "-l", os.path.join(self.datadir, "pg.log"),
+             "-o", f"-p {self.port} -k {self.datadir} -c listen_addresses=127.0.0.1 -c fsync=off -c max_connections=500",
+             "start"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        os.environ.update({
+            "DB_HOST": "127.0.0.1",
+            "DB_PORT": str(self.port),
+            "DB_NAME": "postgres",
+            "DB_USER": "postgres",
+            "DB_PASSWORD": "",
+            "DB_SSLMODE": "disable",
+        })
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.run(
+            [os.path.join(self.bindir, "pg_ctl"), "-D", os.path.join(self.datadir, "data"), "-m", "immediate", "stop"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        shutil.rmtree(self.datadir, ignore_errors=True)
+
+
+class DatabaseEsterno:
+    """
+    Database di prova esistente, da variabili LOADTEST_DB_* separate da quelle
+    dell'app: per il test diventano le DB_* lette da db.connect().
+    """
+
+    VARIABILI = ["HOST", "PORT", "NAME", "USER", "PASSWORD", "SSLMODE"]
+
+    def __init__(self):
+        mancanti = [f"LOADTEST_DB_{v}" for v in ("HOST", "NAME", "USER") if not os.environ.get(f"LOADTEST_DB_{v}")]
+        if mancanti:
+            raise SystemExit(f"--esterno richiede un database di prova: imposta {', '.join(mancanti)}.")
+        self.valori = {v: os.environ[f"LOADTEST_DB_{v}"] for v in self.VARIABILI if f"LOADTEST_DB_{v}" in os.environ}
+        prova = (self.valori["HOST"], self.valori.get("PORT", "5432"), self.valori["NAME"])
+        app = (os.environ.get("DB_HOST"), os.environ.get("DB_PORT", "5432"), os.environ.get("DB_NAME", "postgres"))
+        if prova == app:
+            raise SystemExit(
+                "LOADTEST_DB_* punta allo stesso database di DB_* (quello dell'app): "
+                "il load test ne eliminerebbe i dati. Usa un database di prova."
+            )
+
+    def __enter__(self):
+        for v in self.VARIABILI:
+            os.environ.pop(f"DB_{v}", None)
+        os.environ.update({f"DB_{v}": valore for v, valore in self.valori.items()})
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def prepara_database(immobili: int, anni: int, rate: int):
+    conn = db.connect()
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS spese, immobili CASCADE")
+        cur.execute(SCHEMA_SQL)
+        cur.execute(SEED_SQL, {"immobili": immobili, "anni": anni, "rate": rate})
+    conn.commit()
+    conn.close()
+    # Come un'installazione reale dopo `python cli.py indici`
+    db.ensure_indexes()
+    db.ensure_modifiche()
+
+
+# =========================================================
+# Strumentazione del server: connessioni e query
+# =========================================================
+class Contatori:
+    """
+    Connessioni aperte e query eseguite, in un piccolo file mappato in memoria:
+    il server li incrementa, il test li legge senza aspettare flush o statistiche.
+    """
+
+    FORMATO = "qq"
+
+    def __init__(self, path: str, crea: bool = False):
+        dimensione = struct.calcsize(self.FORMATO)
+        if crea:
+            with open(path, "wb") as fh:
+                fh.write(bytes(dimensione))
+        self._fh = open(path, "r+b")
+        self._mm = mmap.mmap(self._fh.fileno(), dimensione)
+        self.lock = threading.Lock()
+
+    def aggiungi(self, connessioni: int = 0, query: int = 0):
+        with self.lock:
+            c, q = struct.unpack_from(self.FORMATO, self._mm)
+            struct.pack_into(self.FORMATO, self._mm, 0, c + connessioni, q + query)
+
+    def snapshot(self):
+        return struct.unpack_from(self.FORMATO, self._mm)
+
+    def close(self):
+        self._mm.close()
+        self._fh.close()
+
+
+def installa_strumentazione(contatori: Contatori):
+    """
+    Nel processo server: db.connect (usata dal pool) conta le connessioni fisiche
+    aperte, e un cursore dedicato conta le execute eseguite su di esse.
+    """
+    import psycopg2.extensions
+
+    class _CountingCursor(psycopg2.extensions.cursor):
+        def execute(self, query, vars=None):
+            contatori.aggiungi(query=1)
+            return super().execute(query, vars)
+
+        def executemany(self, query, vars_list):
+            contatori.aggiungi(query=1)
+            return super().executemany(query, vars_list)
+
+    orig_connect = db.connect
+
+    def _counting_connect():
+        conn = orig_connect()
+        conn.cursor_factory = _CountingCursor
+        contatori.aggiungi(connessioni=1)
+        return conn
+
+    db.connect = _counting_connect
+
+
+def _opzioni_server(porta: int) -> list:
+    return [
+        "--server.headless", "true",
+        "--server.address", "127.0.0.1",
+        "--server.port", str(porta),
+        "--server.fileWatcherType", "none",
+        "--browser.gatherUsageStats", "false",
+    ]
+
+
+def server_strumentato(app_path: str, porta: str, contatori_path: str):
+    """Punto d'ingresso del processo server: strumentazione, poi `streamlit run`."""
+    installa_strumentazione(Contatori(contatori_path))
+    from streamlit.web import cli
+    sys.argv = ["streamlit", "run", app_path, *_opzioni_server(int(porta))]
+    sys.exit(cli.main())
+
+
+# La cartella dell'app va per prima: db, service, ... sono quelli dell'app misurata.
+_SERVER_STRUMENTATO = """
+import os, sys
+sys.path[:0] = [os.path.dirname(os.path.abspath(sys.argv[1])), sys.argv[3]]
+import loadtest
+loadtest.server_strumentato(sys.argv[1], sys.argv[2], sys.argv[4])
+"""
+
+
+class ServerStreamlit:
+    """
+    `streamlit run` di app_path su una porta libera, con le variabili DB_* correnti.
+    Con contatori_path il server conta connessioni e query (installa_strumentazione).
+    """
+
+    def __init__(self, app_path: str, timeout_s: float, contatori_path: str = None, profilo: bool = False):
+        self.app_path = os.path.abspath(app_path)
+        self.timeout_s = timeout_s
+        self.contatori_path = contatori_path
+        self.profilo = profilo
+        self.porta = None
+        self.proc = None
+        self.t_lancio = None
+        self._log = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://127.0.0.1:{self.porta}/_stcore/stream"
+
+    @property
+    def pid(self) -> int:
+        return self.proc.pid
+
+    def __enter__(self):
+        self.porta = _free_port()
+        env = dict(os.environ, PGAPPNAME=APP_NAME_SERVER, PYTHONUNBUFFERED="1")
+        if self.profilo:
+            env["SPESE_PROFILO"] = "1"
+        if self.contatori_path:
+            cmd = [sys.executable, "-c", _SERVER_STRUMENTATO, self.app_path, str(self.porta),
+                   os.path.dirname(os.path.abspath(__file__)), self.contatori_path]
+        else:
+            cmd = [sys.executable, "-m", "streamlit", "run", self.app_path, *_opzioni_server(self.porta)]
+        self._log = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        self.t_lancio = time.perf_counter()
+        self.proc = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(self.app_path),
+                                     stdout=self._log, stderr=subprocess.STDOUT)
+        try:
+            self._attendi_pronto()
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def _attendi_pronto(self):
+        salute = f"http://127.0.0.1:{self.porta}/_stcore/health"
+        scadenza = time.monotonic() + self.timeout_s
+        while time.monotonic() < scadenza:
+            if self.proc.poll() is not None:
+                raise SystemExit(f"Il server Streamlit è terminato all'avvio:\n{self.output()[-2000:]}")
+            try:
+                with urllib.request.urlopen(salute, timeout=1) as r:
+                    if r.status == 200:
+                        return
+            except (urllib.error.URLError, OSError):
+                pass
+            time.sleep(0.02)
+        raise SystemExit(f"Il server Streamlit non risponde dopo {self.timeout_s:.0f} s:\n{self.output()[-2000:]}")
+
+    def output(self) -> str:
+        self._log.flush()
+        self._log.seek(0)
+        return self._log.read()
+
+    def __exit__(self, *exc):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+
+class Campionatore(threading.Thread):
+    """CPU/RSS del processo server (da /proc) e connessioni attive del server, campionati periodicamente."""
+
+    def __init__(self, pid: int, intervallo_s: float = 0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.intervallo_s = intervallo_s
+        self.stop_event = threading.Event()
+        self.cpu_pct = []
+        self.rss_mb = []
+        self.connessioni_attive = []
+
+    def _cpu_s(self) -> float:
+        # utime + stime (campi 14 e 15 di /proc/<pid>/stat, dopo il nome del comando)
+        with open(f"/proc/{self.pid}/stat") as fh:
+            campi = fh.read().rsplit(")", 1)[1].split()
+        return (int(campi[11]) + int(campi[12])) / os.sysconf("SC_CLK_TCK")
+
+    def _rss_mb(self) -> float:
+        with open(f"/proc/{self.pid}/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+    def run(self):
+        conn = db.connect()
+        conn.autocommit = True
+        try:
+            t0, c0 = time.monotonic(), self._cpu_s()
+            while not self.stop_event.wait(self.intervallo_s):
+                t1, c1 = time.monotonic(), self._cpu_s()
+                self.cpu_pct.append(100.0 * (c1 - c0) / max(t1 - t0, 1e-9))
+                t0, c0 = t1, c1
+                self.rss_mb.append(self._rss_mb())
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT count(*) FROM pg_stat_activity WHERE datname = current_database() AND application_name = %s",
+                        (APP_NAME_SERVER,),
+                    )
+                    self.connessioni_attive.append(cur.fetchone()[0])
+        except OSError:
+            pass  # /proc non disponibile o server terminato
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+# =========================================================
+# Percorsi utente
+# =========================================================
+SCHEDA_PAGAMENTI = "✅ Pagamenti"
+SCHEDA_DASHBOARD = "📊 Dashboard"
+SCHEDA_IMMOBILI = "🏠 Immobili"
+
+
+class WidgetAssente(Exception):
+    pass
+
+
+class Sessione:
+    """
+    Una scheda del browser: un websocket su /_stcore/stream con il proprio
+    session_state sul server. Come il frontend, a ogni rerun invia gli stati
+    dei widget impostati dall'utente e ancora presenti nella pagina.
+    """
+
+    def __init__(self, n: int, url: str, timeout_s: float):
+        self.n = n
+        self.url = url
+        self.rng = random.Random(n)
+        self.timeout_s = timeout_s
+        self.ws = None
+        self.widget = {}   # chiave utente -> elemento protobuf reso nell'ultimo run
+        self.valori = {}   # chiave utente -> (campo WidgetState, valore) scelto dalla sessione
+        self.misure = []   # (passo, secondi, errore)
+        self.scheda = None
+
+    def __enter__(self):
+        from websockets.sync.client import connect
+        self._connessione = connect(self.url, subprotocols=["streamlit"], open_timeout=self.timeout_s, max_size=None)
+        self.ws = self._connessione.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._connessione.__exit__(*exc)
+
+    def _widget(self, chiave: str):
+        """Elemento del widget con questa chiave (o con la chiave versionata chiave__vN)."""
+        for k, el in self.widget.items():
+            if k == chiave or k.startswith(chiave + "__v"):
+                return k, el
+        raise WidgetAssente(f"widget assente: {chiave}")
+
+    def _invia(self, trigger: str = None):
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        msg = BackMsg()
+        msg.rerun_script.query_string = ""
+        msg.rerun_script.page_script_hash = ""
+        stati = msg.rerun_script.widget_states.widgets
+        for chiave, (campo, valore) in self.valori.items():
+            if chiave in self.widget:
+                w = stati.add(id=self.widget[chiave].id)
+                setattr(w, campo, valore)
+        if trigger:
+            stati.add(id=self.widget[trigger].id, trigger_value=True)
+        self.ws.send(msg.SerializeToString())
+
+    def _attendi_fine(self):
+        """Legge i ForwardMsg fino alla fine dello script (anche dopo st.rerun); restituisce l'errore o None."""
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+        scadenza = time.monotonic() + self.timeout_s
+        widget, errore = {}, None
+        while True:
+            fm = ForwardMsg()
+            fm.ParseFromString(self.ws.recv(timeout=max(scadenza - time.monotonic(), 0.001)))
+            tipo = fm.WhichOneof("type")
+            if tipo == "delta":
+                delta = fm.delta
+                if delta.WhichOneof("type") == "new_element":
+                    nome = delta.new_element.WhichOneof("type")
+                    el = getattr(delta.new_element, nome)
+                    if nome == "exception":
+                        errore = errore or f"{el.type}: {el.message}"
+                    elif getattr(el, "id", "").startswith("$$ID-"):
+                        widget[el.id.split("-", 2)[2]] = el
+                elif delta.WhichOneof("type") == "add_block" and delta.add_block.id.startswith("$$ID-"):
+                    widget[delta.add_block.id.split("-", 2)[2]] = delta.add_block
+            elif tipo == "script_finished":
+                if fm.script_finished == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    widget = {}  # st.rerun(): segue un altro run
+                    continue
+                if fm.script_finished == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    errore = errore or "errore di compilazione dello script"
+                self.widget = widget
+                return errore
+
+    def _run(self, passo: str, trigger: str = None) -> bool:
+        from websockets.exceptions import ConnectionClosed
+        t0 = time.perf_counter()
+        try:
+            self._invia(trigger)
+            errore = self._attendi_fine()
+        except TimeoutError:
+            errore = f"timeout dopo {self.timeout_s:.0f} s"
+        except ConnectionClosed as e:
+            errore = f"connessione chiusa: {e}"
+        self.misure.append((passo, time.perf_counter() - t0, errore))
+        return errore is None
+
+    def _imposta(self, passo: str, chiave: str, campo: str, valore) -> bool:
+        k, _ = self._widget(chiave)
+        self.valori[k] = (campo, valore)
+        return self._run(passo)
+
+    def _scegli(self, passo: str, chiave: str, indice=None) -> bool:
+        k, el = self._widget(chiave)
+        if not el.options:
+            raise WidgetAssente(f"nessuna opzione in {chiave}")
+        i = self.rng.randrange(len(el.options)) if indice is None else indice
+        return self._imposta(passo, k, "string_value", el.options[i])
+
+    def _clicca(self, passo: str, chiave: str) -> bool:
+        k, _ = self._widget(chiave)
+        return self._run(passo, trigger=k)
+
+    def apertura(self):
+        return self._run("apertura")
+
+    def apri_scheda(self, etichetta: str):
+        # Le schede di app.py sono lazy: i widget esistono solo in quella aperta
+        if self.scheda == etichetta:
+            return
+        self.scheda = etichetta
+        self._imposta("apri_scheda", "main_tabs", "string_value", etichetta)
+
+    def filtra_pagamenti(self):
+        self.apri_scheda(SCHEDA_PAGAMENTI)
+        self._scegli("filtra_pagamenti", "pay_f_esercizio")
+
+    def segna_pagata(self):
+        self._scegli("filtra_da_pagare", "pay_f_esercizio", 0)
+        if "pay_sel" not in self.widget:
+            return  # nessuna rata da pagare
+        if self._scegli("seleziona_rata", "pay_sel") and self._clicca("pagata", "btn_pay"):
+            self._clicca("registra_pagamento", "pay_registra")
+
+    def dashboard(self):
+        self.apri_scheda(SCHEDA_DASHBOARD)
+        k, el = self._widget("dash_periodo")
+        corrente = self.valori.get(k, ("string_value", el.options[el.default]))[1]
+        self._scegli("dashboard", k, 1 - list(el.options).index(corrente))
+
+    def aggiungi_immobile(self):
+        self.apri_scheda(SCHEDA_IMMOBILI)
+        nome = f"LT {self.n}-{self.rng.randrange(10**9)}"
+        if self._imposta("nome_immobile", "imm_add_name", "string_value", nome):
+            self._clicca("aggiungi_immobile", "imm_add_btn")
+
+    def percorso(self, iterazioni: int):
+        if self.apertura():
+            for _ in range(iterazioni):
+                for passo in (self.filtra_pagamenti, self.segna_pagata, self.dashboard, self.aggiungi_immobile):
+                    try:
+                        passo()
+                    except WidgetAssente as e:
+                        # La pagina non è quella attesa: conta come errore, non come successo
+                        self.misure.append((passo.__name__, 0.0, str(e)))
+                        self.scheda = None
+        return self.misure
+
+
+# =========================================================
+# Esecuzione e report
+# =========================================================
+def percentile(valori, p: float) -> float:
+    if not valori:
+        return 0.0
+    v = sorted(valori)
+    k = (len(v) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(v) - 1)
+    return v[lo] + (v[hi] - v[lo]) * (k - lo)
+
+
+def _server_con_contatori(app_path: str, timeout_s: float):
+    fd, path = tempfile.mkstemp(prefix="spese-loadtest-", suffix=".cnt")
+    os.close(fd)
+    contatori = Contatori(path, crea=True)
+    return ServerStreamlit(app_path, timeout_s, contatori_path=path), contatori, path
+
+
+def calibra_query_per_passo(app_path: str, timeout_s: float) -> dict:
+    """Una sessione sequenziale su un server nuovo: query e connessioni per ogni tipo di interazione."""
+    server, contatori, path = _server_con_contatori(app_path, timeout_s)
+    per_passo = {}
+    try:
+        with server, Sessione(0, server.url, timeout_s) as s:
+            originale = s._run
+
+            def _run_contato(passo, trigger=None):
+                c0, q0 = contatori.snapshot()
+                ok = originale(passo, trigger)
+                c1, q1 = contatori.snapshot()
+                per_passo.setdefault(passo, []).append((q1 - q0, c1 - c0))
+                return ok
+
+            s._run = _run_contato
+            s.percorso(1)
+    finally:
+        contatori.close()
+        os.unlink(path)
+    return {
+        passo: {"query": sum(q for q, _ in v) / len(v), "connessioni": sum(c for _, c in v) / len(v)}
+        for passo, v in per_passo.items()
+    }
+
+
+def _percorso(n: int, url: str, iterazioni: int, timeout_s: float) -> list:
+    with Sessione(n, url, timeout_s) as s:
+        return s.percorso(iterazioni)
+
+
+def esegui_carico(app_path: str, n_sessioni: int, iterazioni: int, timeout_s: float) -> dict:
+    server, contatori, path = _server_con_contatori(app_path, timeout_s)
+    try:
+        with server:
+            camp = Campionatore(server.pid)
+            camp.start()
+            c0, q0 = contatori.snapshot()
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=n_sessioni) as pool:
+                futures = [pool.submit(_percorso, i + 1, server.url, iterazioni, timeout_s) for i in range(n_sessioni)]
+                misure = []
+                for f in futures:
+                    try:
+                        misure.extend(f.result())
+                    except Exception as e:  # connessione websocket rifiutata
+                        misure.append(("connessione", 0.0, f"{type(e).__name__}: {e}"))
+            durata = time.perf_counter() - t0
+            c1, q1 = contatori.snapshot()
+            camp.stop()
+    finally:
+        contatori.close()
+        os.unlink(path)
+
+    tempi = [t for _, t, err in misure if err is None]
+    errori = [err for _, _, err in misure if err is not None]
+    per_passo = {}
+    for passo, t, err in misure:
+        if err is None:
+            per_passo.setdefault(passo, []).append(t)
+
+    return {
+        "sessioni": n_sessioni,
+        "interazioni": len(misure),
+        "errori": len(errori),
+        "esempi_errori": sorted(set(errori))[:5],
+        "durata_s": durata,
+        "interazioni_al_s": len(misure) / durata if durata else 0.0,
+        "latenza_ms": {p: 1000 * percentile(tempi, p) for p in (50, 95, 99)},
+        "latenza_ms_per_passo": {
+            passo: {p: 1000 * percentile(v, p) for p in (50, 95, 99)} for passo, v in sorted(per_passo.items())
+        },
+        "connessioni_aperte": c1 - c0,
+        "connessioni_picco": max(camp.connessioni_attive, default=0),
+        "query_totali": q1 - q0,
+        "query_per_interazione": (q1 - q0) / len(misure) if misure else 0.0,
+        "cpu_pct_media": sum(camp.cpu_pct) / len(camp.cpu_pct) if camp.cpu_pct else 0.0,
+        "cpu_pct_max": max(camp.cpu_pct, default=0.0),
+        "rss_mb_max": max(camp.rss_mb, default=0.0),
+    }
+
+
+def misura_avvio(app_path: str, n: int, timeout_s: float) -> dict:
+    """
+    Primo render in n server nuovi: dal lancio di `streamlit run` (import compresi)
+    alla fine del primo script di una sessione, e durata del solo primo script.
+    """
+    totale, script, errori, profilo = [], [], 0, ""
+    for _ in range(n):
+        with ServerStreamlit(app_path, timeout_s, profilo=True) as server:
+            try:
+                with Sessione(0, server.url, timeout_s) as s:
+                    ok = s.apertura()
+                    fine = time.perf_counter()
+            except Exception:
+                ok = False
+            if not ok:
+                errori += 1
+                continue
+            totale.append(fine - server.t_lancio)
+            script.append(s.misure[0][1])
+            time.sleep(0.2)
+            righe = [r for r in server.output().splitlines() if r.startswith("[profilo]")]
+            profilo = righe[0] if righe else profilo
+    return {
+        "processi": n,
+        "p50_ms": percentile(totale, 50) * 1000,
+        "max_ms": max(totale, default=0.0) * 1000,
+        "script_p50_ms": percentile(script, 50) * 1000,
+        "errori": errori,
+        "profilo": profilo,
+    }
+
+
+def stampa_report(calibrazione: dict, risultati: list):
+    if calibrazione:
+        print("\nQuery e connessioni per interazione (sessione singola):")
+        for passo, v in calibrazione.items():
+            print(f"  {passo:<20} query {v['query']:>5.1f}   connessioni {v['connessioni']:>5.1f}")
+
+    if not risultati:
+        return
+    print(f"\n{'sessioni':>8} {'inter.':>7} {'err':>4} {'int/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'conn':>6} {'picco':>6} {'q/int':>6} {'cpu%':>6} {'cpu% max':>8} {'RSS MB':>7}")
+    for r in risultati:
+        lat = r["latenza_ms"]
+        print(f"{r['sessioni']:>8} {r['interazioni']:>7} {r['errori']:>4} {r['interazioni_al_s']:>7.1f} "
+              f"{lat[50]:>8.0f} {lat[95]:>8.0f} {lat[99]:>8.0f} {r['connessioni_aperte']:>6} {r['connessioni_picco']:>6} "
+              f"{r['query_per_interazione']:>6.1f} {r['cpu_pct_media']:>6.0f} {r['cpu_pct_max']:>8.0f} {r['rss_mb_max']:>7.0f}")
+        for err in r["esempi_errori"]:
+            print(f"         errore: {err}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Load test di app.py su un server Streamlit reale")
+    parser.add_argument("--sessioni", default="1,5,10",
+                        help="sessioni contemporanee, anche più livelli: 1,5,10 (0 = solo --avvio)")
+    parser.add_argument("--iterazioni", type=int, default=3, help="ripetizioni del percorso per sessione")
+    parser.add_argument("--immobili", type=int, default=20)
+    parser.add_argument("--anni", type=int, default=5)
+    parser.add_argument("--rate", type=int, default=4, choices=[1, 2, 3, 4, 6, 12])
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout di un'interazione e dell'avvio del server (s)")
+    parser.add_argument("--app", default=APP_PATH, help="app Streamlit da misurare (default: app.py accanto al test)")
+    parser.add_argument("--esterno", action="store_true",
+                        help="usa il database di prova delle variabili LOADTEST_DB_* (le sue tabelle vengono ricreate)")
+    parser.add_argument("--avvio", type=int, default=0, help="misura il primo render a freddo in N server nuovi")
+    parser.add_argument("--json", help="salva i risultati anche in questo file")
+    args = parser.parse_args(argv)
+    livelli = [int(x) for x in args.sessioni.split(",") if x.strip() and int(x) > 0]
+
+    pg = DatabaseEsterno() if args.esterno else LocalPostgres()
+    pg.__enter__()
+    try:
+        calibrazione, risultati = {}, []
+        if livelli:
+            prepara_database(args.immobili, args.anni, args.rate)
+            calibrazione = calibra_query_per_passo(args.app, args.timeout)
+        for n in livelli:
+            prepara_database(args.immobili, args.anni, args.rate)
+            risultati.append(esegui_carico(args.app, n, args.iterazioni, args.timeout))
+        avvio = None
+        if args.avvio:
+            prepara_database(args.immobili, args.anni, args.rate)
+            avvio = misura_avvio(args.app, args.avvio, args.timeout)
+    finally:
+        pg.__exit__(None, None, None)
+
+    stampa_report(calibrazione, risultati)
+    if avvio:
+        print(f"\nPrimo render a freddo ({avvio['processi']} server): "
+              f"p50 {avvio['p50_ms']:.0f} ms dal lancio (max {avvio['max_ms']:.0f} ms), "
+              f"primo script p50 {avvio['script_p50_ms']:.0f} ms, errori {avvio['errori']}")
+        if avvio["profilo"]:
+            print(f"  {avvio['profilo']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"calibrazione": calibrazione, "risultati": risultati, "avvio": avvio}, fh, indent=2, default=str)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
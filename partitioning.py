@@ -0,0 +1,369 @@
+"""
+Partizionamento dichiarativo della tabella spese per esercizio.
+
+La tabella spese diventa PARTITION BY LIST (esercizio) con una partizione
+per anno (spese_<anno>) più una partizione DEFAULT (spese_default) che
+raccoglie eventuali anni non ancora creati. Le query filtrate per esercizio
+leggono solo le partizioni interessate (partition pruning) e gli anni vecchi
+possono essere staccati e archiviati senza toccare quelli recenti.
+
+Operazioni (anche da riga di comando: python cli.py partizioni ...):
+  - migra_spese():         converte la tabella esistente, copiando i dati;
+  - ensure_partizioni():   crea le partizioni mancanti (chiamata da insert_rate);
+  - archivia_esercizio():  stacca un anno e lo sposta nello schema "archivio";
+  - ripristina_esercizio(): lo riporta nello schema public e lo riattacca.
+
+Lo stato delle partizioni si legge sempre dal catalogo, non da cache di
+processo: un anno può essere archiviato o ripristinato da un altro processo.
+Gli anni archiviati non ricevono nuove rate finché non vengono ripristinati.
+"""
+import re
+import time
+
+from psycopg2 import sql
+
+from db import crea_trigger_modifiche, get_conn
+
+TABELLA = "spese"
+PARTIZIONE_DEFAULT = "spese_default"
+SCHEMA_ARCHIVIO = "archivio"
+
+# Dopo aver visto spese non partizionata, ensure_partizioni non interroga
+# il catalogo per questi secondi (migra_spese può girare in un altro processo).
+VERIFICA_PARTIZIONAMENTO_S = 300.0
+_non_partizionata_dal = None
+
+# Indici creati sulla tabella padre: PostgreSQL li propaga a ogni partizione,
+# comprese quelle create in seguito.
+INDICI = {
+    "idx_spese_immobile": "CREATE INDEX IF NOT EXISTS idx_spese_immobile ON spese (immobile_id)",
+    "idx_spese_scadenza": "CREATE INDEX IF NOT EXISTS idx_spese_scadenza ON spese (scadenza)",
+    "idx_spese_da_pagare_scadenza":
+        "CREATE INDEX IF NOT EXISTS idx_spese_da_pagare_scadenza ON spese (scadenza, id) WHERE stato = 'Da pagare'",
+}
+
+def nome_partizione(anno: int) -> str:
+    return f"{TABELLA}_{int(anno)}"
+
+
+def _lock(cur):
+    # Serializza le modifiche allo schema delle partizioni tra processi diversi.
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('spese_partizioni'))")
+
+
+def is_partizionata(cur) -> bool:
+    cur.execute(
+        """
+        SELECT 1 FROM pg_partitioned_table p
+        JOIN pg_class c ON c.oid = p.partrelid
+        WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace
+        """,
+        (TABELLA,),
+    )
+    return cur.fetchone() is not None
+
+
+def elenco_partizioni(cur) -> list:
+    """Partizioni attaccate a spese: lista di (nome, righe stimate)."""
+    cur.execute(
+        """
+        SELECT c.relname, c.reltuples::bigint
+        FROM pg_inherits h
+        JOIN pg_class c ON c.oid = h.inhrelid
+        WHERE h.inhparent = 'public.spese'::regclass
+        ORDER BY c.relname
+        """
+    )
+    return cur.fetchall()
+
+
+def esercizi_presenti(cur) -> list:
+    """
+    Anni con almeno una spesa, dal catalogo: una partizione per anno (basta
+    un EXISTS per dire se è vuota) più gli anni finiti nella DEFAULT.
+    """
+    anni = set()
+    for nome, _ in elenco_partizioni(cur):
+        m = re.fullmatch(rf"{TABELLA}_(\d+)", nome)
+        if not m:
+            continue
+        cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(sql.Identifier(nome)))
+        if cur.fetchone()[0]:
+            anni.add(int(m.group(1)))
+    cur.execute("SELECT to_regclass(%s)", (f"public.{PARTIZIONE_DEFAULT}",))
+    if cur.fetchone()[0] is not None:
+        cur.execute(sql.SQL("SELECT DISTINCT esercizio FROM {}").format(sql.Identifier(PARTIZIONE_DEFAULT)))
+        anni.update(int(r[0]) for r in cur.fetchall())
+    return sorted(anni)
+
+
+def schemi_partizioni(cur, anni) -> dict:
+    """Per ogni anno, gli schemi (public e/o archivio) in cui esiste la tabella spese_<anno>."""
+    nomi = {nome_partizione(a): int(a) for a in anni}
+    cur.execute(
+        """
+        SELECT n.nspname, c.relname FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relname = ANY(%s) AND n.nspname IN ('public', %s)
+        """,
+        (list(nomi), SCHEMA_ARCHIVIO),
+    )
+    schemi = {a: set() for a in nomi.values()}
+    for schema, nome in cur.fetchall():
+        schemi[nomi[nome]].add(schema)
+    return schemi
+
+
+def _stacca_default(cur, anno: int) -> bool:
+    """
+    PostgreSQL non attacca (né crea) la partizione di un anno se la DEFAULT
+    ne contiene righe: in quel caso la DEFAULT viene staccata e va riattaccata
+    con _riattacca_default dopo aver creato/attaccato la partizione.
+    """
+    cur.execute(
+        sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE esercizio = %s)").format(sql.Identifier(PARTIZIONE_DEFAULT)),
+        (int(anno),),
+    )
+    if not cur.fetchone()[0]:
+        return False
+    cur.execute(sql.SQL("ALTER TABLE spese DETACH PARTITION {}").format(sql.Identifier(PARTIZIONE_DEFAULT)))
+    return True
+
+
+def _riattacca_default(cur, anno: int):
+    """Sposta nella partizione dell'anno le righe rimaste nella DEFAULT e la riattacca."""
+    cur.execute(
+        sql.SQL("WITH mosse AS (DELETE FROM {} WHERE esercizio = %s RETURNING *) INSERT INTO spese OVERRIDING SYSTEM VALUE SELECT * FROM mosse")
+        .format(sql.Identifier(PARTIZIONE_DEFAULT)),
+        (int(anno),),
+    )
+    cur.execute(sql.SQL("ALTER TABLE spese ATTACH PARTITION {} DEFAULT").format(sql.Identifier(PARTIZIONE_DEFAULT)))
+
+
+def _crea_partizione(cur, anno: int):
+    """Crea la partizione dell'anno, spostando le righe già finite nella DEFAULT."""
+    nome = nome_partizione(anno)
+    cur.execute("SELECT to_regclass(%s)", (f"public.{nome}",))
+    if cur.fetchone()[0] is not None:
+        return
+
+    in_default = _stacca_default(cur, anno)
+    cur.execute(
+        sql.SQL("CREATE TABLE {} PARTITION OF spese FOR VALUES IN ({})").format(
+            sql.Identifier(nome), sql.Literal(int(anno))
+        )
+    )
+    if in_default:
+        _riattacca_default(cur, anno)
+
+
+def ensure_partizioni(anni, cur=None) -> bool:
+    """
+    Garantisce che esistano le partizioni per gli anni indicati, verificando
+    il catalogo. Con `cur` lavora nella transazione del chiamante (es. la
+    INSERT di insert_rate), senza aprire un'altra connessione.
+    Restituisce False (senza fare nulla) se spese non è partizionata;
+    solleva ValueError se un anno è archiviato.
+    """
+    global _non_partizionata_dal
+    anni = sorted({int(a) for a in anni})
+    if not anni:
+        return True
+    if _non_partizionata_dal is not None and time.monotonic() - _non_partizionata_dal < VERIFICA_PARTIZIONAMENTO_S:
+        return False
+    if cur is None:
+        with get_conn() as conn:
+            with conn.cursor() as cur:
+                esito = ensure_partizioni(anni, cur)
+            conn.commit()
+        return esito
+
+    if not is_partizionata(cur):
+        _non_partizionata_dal = time.monotonic()
+        return False
+    _non_partizionata_dal = None
+    schemi = schemi_partizioni(cur, anni)
+    archiviati = [a for a in anni if SCHEMA_ARCHIVIO in schemi[a]]
+    if archiviati:
+        raise ValueError(
+            f"Esercizi archiviati: {', '.join(map(str, archiviati))}. "
+            "Ripristinarli (cli.py partizioni ripristina <anno>) prima di inserire nuove rate."
+        )
+    mancanti = [a for a in anni if "public" not in schemi[a]]
+    if mancanti:
+        _lock(cur)
+        for anno in mancanti:
+            _crea_partizione(cur, anno)
+    return True
+
+
+def _chiavi_esterne(cur, tabella: str) -> list:
+    """Vincoli FOREIGN KEY della tabella: lista di (nome, definizione), ON DELETE/UPDATE compresi."""
+    cur.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+        (f"public.{tabella}",),
+    )
+    return cur.fetchall()
+
+
+def _sgancia_copia(cur):
+    """
+    La copia spese_pre_partizione non deve più vincolare immobili: le sue FK
+    impedirebbero di eliminare un immobile che non ha più spese vive.
+    """
+    cur.execute("SELECT to_regclass('public.spese_pre_partizione')")
+    if cur.fetchone()[0] is None:
+        return
+    for nome, _ in _chiavi_esterne(cur, "spese_pre_partizione"):
+        cur.execute(sql.SQL("ALTER TABLE spese_pre_partizione DROP CONSTRAINT {}").format(sql.Identifier(nome)))
+
+
+def migra_spese(elimina_vecchia: bool = False) -> list:
+    """
+    Converte spese in tabella partizionata per esercizio, in un'unica
+    transazione. La tabella originale resta come spese_pre_partizione, senza
+    chiavi esterne (o viene eliminata con elimina_vecchia=True). Le FK verso
+    immobili vengono ricreate con la loro definizione originale. Restituisce
+    gli anni creati. Permessi (GRANT) e policy RLS non vengono copiati.
+    """
+    global _non_partizionata_dal
+    _non_partizionata_dal = None
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if is_partizionata(cur):
+                # già migrata (anche con versioni precedenti): sgancia solo la copia
+                _sgancia_copia(cur)
+                conn.commit()
+                return []
+            _lock(cur)
+            cur.execute("LOCK TABLE spese IN ACCESS EXCLUSIVE MODE")
+
+            cur.execute("SELECT COUNT(*) FROM spese WHERE esercizio IS NULL")
+            if cur.fetchone()[0]:
+                raise ValueError("Esistono spese senza esercizio: valorizzarle prima della migrazione.")
+
+            # Sequenza dell'id (serial o identity) da riallineare dopo la copia
+            cur.execute("SELECT pg_get_serial_sequence('public.spese', 'id')")
+            seq_vecchia = cur.fetchone()[0]
+
+            cur.execute(
+                """
+                CREATE TABLE spese_partizionata
+                (LIKE spese INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS INCLUDING GENERATED)
+                PARTITION BY LIST (esercizio)
+                """
+            )
+            # La chiave primaria di una tabella partizionata deve includere la chiave di partizione.
+            cur.execute("ALTER TABLE spese_partizionata ALTER COLUMN esercizio SET NOT NULL")
+            cur.execute("ALTER TABLE spese_partizionata ADD PRIMARY KEY (id, esercizio)")
+            for nome, definizione in _chiavi_esterne(cur, TABELLA):
+                cur.execute(
+                    sql.SQL("ALTER TABLE spese_partizionata ADD CONSTRAINT {} ").format(sql.Identifier(nome))
+                    + sql.SQL(definizione)
+                )
+            cur.execute(
+                sql.SQL("CREATE TABLE {} PARTITION OF spese_partizionata DEFAULT").format(sql.Identifier(PARTIZIONE_DEFAULT))
+            )
+
+            cur.execute("SELECT DISTINCT esercizio FROM spese ORDER BY esercizio")
+            anni = [int(r[0]) for r in cur.fetchall()]
+            for anno in anni:
+                cur.execute(
+                    sql.SQL("CREATE TABLE {} PARTITION OF spese_partizionata FOR VALUES IN ({})").format(
+                        sql.Identifier(nome_partizione(anno)), sql.Literal(anno)
+                    )
+                )
+
+            cur.execute("INSERT INTO spese_partizionata OVERRIDING SYSTEM VALUE SELECT * FROM spese")
+
+            cur.execute("ALTER TABLE spese RENAME TO spese_pre_partizione")
+            cur.execute("ALTER TABLE spese_partizionata RENAME TO spese")
+            for nome, stmt in INDICI.items():
+                # gli indici della tabella originale liberano il nome per quelli nuovi
+                cur.execute(
+                    sql.SQL("ALTER INDEX IF EXISTS {} RENAME TO {}").format(
+                        sql.Identifier(nome), sql.Identifier(nome + "_pre_partizione")
+                    )
+                )
+                cur.execute(stmt)
+
+            cur.execute("SELECT to_regclass('public.modifiche')")
+            if cur.fetchone()[0] is not None:
+                crea_trigger_modifiche(cur, TABELLA)
+
+            cur.execute("SELECT pg_get_serial_sequence('public.spese', 'id')")
+            seq_nuova = cur.fetchone()[0]
+            if seq_nuova and seq_nuova != seq_vecchia:
+                # identity: la nuova sequenza riparte da 1, va portata oltre il max(id)
+                cur.execute("SELECT setval(%s, COALESCE((SELECT MAX(id) FROM spese), 0) + 1, false)", (seq_nuova,))
+            elif seq_vecchia:
+                # serial: la sequenza è condivisa, la si lega alla nuova tabella
+                cur.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY spese.id").format(sql.SQL(seq_vecchia)))
+
+            if elimina_vecchia:
+                cur.execute("DROP TABLE spese_pre_partizione")
+            else:
+                _sgancia_copia(cur)
+        conn.commit()
+    return anni
+
+
+def archivia_esercizio(anno: int, compatta: bool = False):
+    """
+    Stacca la partizione dell'anno e la sposta nello schema archivio:
+    le query dell'app non la leggono più. Con compatta=True la tabella
+    archiviata viene riscritta (VACUUM FULL) per recuperare spazio.
+    """
+    nome = nome_partizione(anno)
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            _lock(cur)
+            if not is_partizionata(cur):
+                raise ValueError("La tabella spese non è partizionata (usa: partizioni migra).")
+            schemi = schemi_partizioni(cur, [anno])[int(anno)]
+            if "public" not in schemi:
+                if SCHEMA_ARCHIVIO in schemi:
+                    raise ValueError(f"L'esercizio {anno} è già archiviato.")
+                raise ValueError(f"Nessuna partizione per l'esercizio {anno}.")
+            if SCHEMA_ARCHIVIO in schemi:
+                raise ValueError(
+                    f"Esiste già {SCHEMA_ARCHIVIO}.{nome}: rimuoverla o ripristinarla prima di archiviare di nuovo."
+                )
+            cur.execute(sql.SQL("ALTER TABLE spese DETACH PARTITION {}").format(sql.Identifier(nome)))
+            cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(SCHEMA_ARCHIVIO)))
+            cur.execute(sql.SQL("ALTER TABLE {} SET SCHEMA {}").format(sql.Identifier(nome), sql.Identifier(SCHEMA_ARCHIVIO)))
+        conn.commit()
+        if compatta:
+            # VACUUM non può girare dentro una transazione
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("VACUUM FULL {}.{}").format(sql.Identifier(SCHEMA_ARCHIVIO), sql.Identifier(nome)))
+
+
+def ripristina_esercizio(anno: int):
+    """
+    Riporta un anno archiviato nello schema public e lo riattacca a spese.
+    Le righe di quell'anno finite nel frattempo nella DEFAULT vengono spostate
+    nella partizione ripristinata.
+    """
+    nome = nome_partizione(anno)
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            _lock(cur)
+            schemi = schemi_partizioni(cur, [anno])[int(anno)]
+            if SCHEMA_ARCHIVIO not in schemi:
+                raise ValueError(f"L'esercizio {anno} non è archiviato.")
+            if "public" in schemi:
+                raise ValueError(
+                    f"Esiste già public.{nome}: spostarne le righe e rimuoverla prima di ripristinare l'archivio."
+                )
+            in_default = _stacca_default(cur, anno)
+            cur.execute(sql.SQL("ALTER TABLE {}.{} SET SCHEMA public").format(sql.Identifier(SCHEMA_ARCHIVIO), sql.Identifier(nome)))
+            cur.execute(
+                sql.SQL("ALTER TABLE spese ATTACH PARTITION {} FOR VALUES IN ({})").format(
+                    sql.Identifier(nome), sql.Literal(int(anno))
+                )
+            )
+            if in_default:
+                _riattacca_default(cur, anno)
+        conn.commit()
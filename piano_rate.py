@@ -0,0 +1,74 @@
+"""
+Generatore di piani rate.
+
+Da una regola (importo totale, numero rate, frequenza, prima scadenza)
+produce tutte le rate per più immobili ed esercizi in un unico DataFrame,
+calcolato in modo vettoriale (nessun ciclo per rata).
+"""
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+# Mesi tra una rata e la successiva
+FREQUENZE = {"Mensile": 1, "Bimestrale": 2, "Trimestrale": 3, "Semestrale": 6, "Annuale": 12}
+
+COLONNE_PIANO = [
+    "immobile_id", "immobile", "esercizio", "tipo_spesa",
+    "numero_rata", "numero_rate_totali", "scadenza", "importo",
+]
+
+
+def genera_piano(immobili, esercizi, importo_totale: float, n_rate: int, prima_scadenza: date,
+                 frequenza: str = "Trimestrale", tipo_spesa: str = "Ordinario") -> pd.DataFrame:
+    """
+    Genera il piano rate per ogni (immobile, esercizio).
+
+    - immobili: lista di (immobile_id, nome);
+    - esercizi: anni a cui applicare la regola; prima_scadenza si riferisce al
+      primo esercizio e per gli altri viene spostata dello stesso numero di anni;
+    - importo_totale è per immobile ed esercizio: le rate sono uguali al
+      centesimo e l'eventuale resto dell'arrotondamento va sull'ultima rata;
+    - se il giorno non esiste nel mese (es. 31), si usa l'ultimo giorno del mese.
+    """
+    n_rate = int(n_rate)
+    if n_rate < 1:
+        raise ValueError("Il numero di rate deve essere almeno 1.")
+    if frequenza not in FREQUENZE:
+        raise ValueError(f"Frequenza non valida: {frequenza}")
+    if not immobili or not esercizi:
+        return pd.DataFrame(columns=COLONNE_PIANO)
+
+    imm = pd.DataFrame(list(immobili), columns=["immobile_id", "immobile"])
+    esercizi = sorted({int(e) for e in esercizi})
+
+    grid = pd.MultiIndex.from_product(
+        [range(len(imm)), esercizi, range(n_rate)], names=["_imm", "esercizio", "_k"]
+    ).to_frame(index=False)
+
+    # Scadenze: aritmetica sui mesi, poi giorno limitato alla fine del mese
+    mesi = (
+        prima_scadenza.year * 12 + (prima_scadenza.month - 1)
+        + (grid["esercizio"] - esercizi[0]) * 12
+        + grid["_k"] * FREQUENZE[frequenza]
+    )
+    inizio_mese = pd.to_datetime(pd.DataFrame({"year": mesi // 12, "month": mesi % 12 + 1, "day": 1}))
+    giorno = np.minimum(prima_scadenza.day, inizio_mese.dt.days_in_month)
+    scadenza = (inizio_mese + pd.to_timedelta(giorno - 1, unit="D")).dt.date
+
+    # Importi in centesimi: rate uguali, resto sull'ultima
+    centesimi = int(round(float(importo_totale) * 100))
+    base = centesimi // n_rate
+    ultima = centesimi - base * (n_rate - 1)
+    importo = np.where(grid["_k"] == n_rate - 1, ultima, base) / 100.0
+
+    return pd.DataFrame({
+        "immobile_id": imm["immobile_id"].to_numpy()[grid["_imm"]],
+        "immobile": imm["immobile"].to_numpy()[grid["_imm"]],
+        "esercizio": grid["esercizio"],
+        "tipo_spesa": tipo_spesa,
+        "numero_rata": grid["_k"] + 1,
+        "numero_rate_totali": n_rate,
+        "scadenza": scadenza,
+        "importo": importo,
+    })[COLONNE_PIANO]
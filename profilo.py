@@ -0,0 +1,63 @@
+"""
+Profilo di avvio di app.py (SPESE_PROFILO=1).
+
+Streamlit riesegue app.py a ogni interazione, ma questo modulo viene
+importato una sola volta per processo: l'istante di partenza è quello del
+primo run e solo il thread di quel run registra i passi. A fine script
+chiudi() stampa la riga [profilo] su stderr una volta sola; i run successivi
+e le altre sessioni non aggiungono né stampano nulla.
+"""
+import os
+import sys
+import threading
+import time
+
+ATTIVO = os.environ.get("SPESE_PROFILO") == "1"
+
+_T_AVVIO = time.perf_counter()
+_lock = threading.Lock()
+_thread = None    # thread del primo run dello script
+_passi = []       # (passo, ms dall'avvio)
+_chiuso = False
+
+
+def _primo_run() -> bool:
+    global _thread
+    if _chiuso:
+        return False
+    if _thread is None:
+        _thread = threading.get_ident()
+    return _thread == threading.get_ident()
+
+
+def segna(passo: str):
+    """Registra `passo` (ms dall'import del modulo) se siamo nel primo run del processo."""
+    if not ATTIVO:
+        return
+    with _lock:
+        if _primo_run():
+            _passi.append((passo, (time.perf_counter() - _T_AVVIO) * 1000))
+
+
+def chiudi():
+    """Fine del primo run: stampa il profilo su stderr (una volta per processo)."""
+    global _chiuso
+    if not ATTIVO:
+        return
+    with _lock:
+        if not _primo_run():
+            return
+        _chiuso = True
+    print("[profilo] " + " | ".join(f"{passo} {delta:.0f} ms" for passo, _, delta in passi()), file=sys.stderr)
+
+
+def passi() -> list:
+    """Passi del primo run: (passo, ms dall'avvio, ms dal passo precedente)."""
+    with _lock:
+        registrati = list(_passi)
+    precedente = 0.0
+    righe = []
+    for passo, ms in registrati:
+        righe.append((passo, ms, ms - precedente))
+        precedente = ms
+    return righe
@@ -0,0 +1,222 @@
+"""
+Scheduler delle scadenze.
+
+Tiene in memoria un min-heap degli avvisi da generare per le rate da pagare
+(preavviso "in scadenza" e "scaduta") e lo fa avanzare man mano che passano
+i giorni. Dal DB legge solo a range sull'indice parziale delle rate da
+pagare: al primo avvio quelle fino all'orizzonte, poi solo la nuova finestra
+di giorni e le rate inserite dopo l'ultimo id visto. Le scritture dell'app
+arrivano da update(); quelle di altri processi (CLI, altre istanze) si
+riconoscono dal contatore modifiche (service.versione_dati) e solo allora
+le rate da pagare fino all'orizzonte vengono rilette. Non riscansiona mai
+l'intera tabella spese.
+
+I promemoria vengono restituiti da advance() e, se configurato, accodati a
+un file outbox in formato JSON lines (un promemoria per riga).
+"""
+import heapq
+import json
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import service
+
+IN_SCADENZA = "in_scadenza"
+SCADUTA = "scaduta"
+
+
+class ScadenzeScheduler:
+    def __init__(self, preavviso_giorni: int = 7, orizzonte_giorni: int = 60,
+                 outbox_path: str = None, min_intervallo_s: float = 60.0):
+        if orizzonte_giorni < preavviso_giorni:
+            raise ValueError("orizzonte_giorni deve essere >= preavviso_giorni")
+        self.preavviso = timedelta(days=preavviso_giorni)
+        self.orizzonte = timedelta(days=orizzonte_giorni)
+        self.outbox_path = outbox_path
+        self.min_intervallo_s = min_intervallo_s
+
+        self._heap = []          # (data_avviso, tipo, spesa_id, scadenza)
+        self._rate = {}          # spesa_id -> riga, solo rate da pagare tracciate
+        self._inviati = set()    # (spesa_id, tipo, scadenza iso) già notificati
+        self._caricato_fino = None
+        self._max_id = 0
+        self._versione = None    # contatore modifiche già recepito (None = non installato)
+        self._ultimo_carico = 0.0
+        self._lock = threading.Lock()
+
+        if outbox_path:
+            self._inviati |= self._leggi_outbox()
+
+    # -----------------------------------------------------
+    # Stato in memoria
+    # -----------------------------------------------------
+    def _push(self, row: dict):
+        sid = int(row["id"])
+        scad = service.to_date(row["scadenza"])
+        self._rate[sid] = dict(row, scadenza=scad)
+        self._max_id = max(self._max_id, sid)
+        heapq.heappush(self._heap, (scad - self.preavviso, IN_SCADENZA, sid, scad))
+        heapq.heappush(self._heap, (scad + timedelta(days=1), SCADUTA, sid, scad))
+
+    def _carica(self, oggi: date, forza: bool = False):
+        limite = oggi + self.orizzonte
+        if self._caricato_fino is not None and not forza and limite <= self._caricato_fino and \
+                time.monotonic() - self._ultimo_carico < self.min_intervallo_s:
+            return
+        # Letto prima delle rate: una scrittura concorrente verrà rivista alla prossima ricarica
+        versione = service.versione_dati()
+        if self._caricato_fino is None or (versione is not None and versione != self._versione):
+            # Primo caricamento, o scritture non passate da update() (CLI, altro processo):
+            # rilettura delle rate da pagare fino all'orizzonte, che toglie le pagate o
+            # eliminate e riprende quelle tornate "Da pagare"
+            rows = service.rate_da_pagare(limite)
+            ids = {int(r["id"]) for r in rows}
+            for sid in set(self._rate) - ids:
+                del self._rate[sid]
+        elif versione is not None and limite <= self._caricato_fino:
+            rows = []  # nessuna modifica e nessun giorno nuovo
+        else:
+            rows = service.rate_da_pagare(limite, scadenza_dopo=self._caricato_fino, id_dopo=self._max_id)
+        for row in rows:
+            vecchia = self._rate.get(int(row["id"]))
+            if vecchia is None or vecchia["scadenza"] != service.to_date(row["scadenza"]):
+                self._push(row)
+            else:
+                self._rate[int(row["id"])] = dict(row, scadenza=vecchia["scadenza"])
+        self._versione = versione
+        self._caricato_fino = max(limite, self._caricato_fino or limite)
+        self._ultimo_carico = time.monotonic()
+
+    def update(self, row: dict, deleted: bool = False, versione: int = None):
+        """
+        Allinea lo scheduler a una riga appena scritta (es. restituita da
+        RETURNING): le rate pagate/eliminate escono, quelle da pagare entrano.
+        Le voci vecchie nell'heap vengono scartate in modo lazy.
+        `versione` è il contatore modifiche dopo la scrittura
+        (service.ultima_versione_scritta): se è il successivo di quello già
+        recepito, la scrittura non provoca una rilettura alla ricarica.
+        """
+        if not row:
+            return
+        with self._lock:
+            if versione is not None and self._versione is not None and versione == self._versione + 1:
+                self._versione = versione
+            sid = int(row["id"])
+            if deleted or row.get("stato") != "Da pagare":
+                self._rate.pop(sid, None)
+                return
+            if self._caricato_fino is not None and service.to_date(row["scadenza"]) <= self._caricato_fino:
+                self._push(row)
+
+    @property
+    def pronto(self) -> bool:
+        """True dopo il primo caricamento dal DB (advance non farà la query iniziale)."""
+        return self._caricato_fino is not None
+
+    def precarica(self, oggi: date = None):
+        """Primo caricamento senza generare promemoria (es. in background all'avvio)."""
+        with self._lock:
+            self._carica(oggi or date.today())
+
+    # -----------------------------------------------------
+    # Avanzamento
+    # -----------------------------------------------------
+    def advance(self, oggi: date = None, forza: bool = False) -> list:
+        """
+        Porta lo scheduler al giorno `oggi` e restituisce i nuovi promemoria
+        (dict con tipo, id, immobile, esercizio, numero_rata, scadenza, importo).
+        """
+        oggi = oggi or date.today()
+        with self._lock:
+            self._carica(oggi, forza=forza)
+
+            candidati, visti = [], set()
+            while self._heap and self._heap[0][0] <= oggi:
+                _, tipo, sid, scad = heapq.heappop(self._heap)
+                row = self._rate.get(sid)
+                if row is None or row["scadenza"] != scad:
+                    continue  # voce superata (pagata, eliminata o riprogrammata)
+                if tipo == IN_SCADENZA and scad < oggi:
+                    continue  # già scaduta: basta l'avviso di scadenza
+                chiave = (sid, tipo, scad.isoformat())
+                if chiave in self._inviati or chiave in visti:
+                    continue  # già notificato, o doppione di una rata rientrata
+                visti.add(chiave)
+                candidati.append((tipo, row))
+
+            if not candidati:
+                return []
+
+            # Le rate potrebbero essere state pagate da un'altra sessione o dalla CLI:
+            # verifica solo i candidati, non l'intera tabella.
+            ancora = service.ids_ancora_da_pagare({int(r["id"]) for _, r in candidati})
+            promemoria = []
+            for tipo, row in candidati:
+                sid = int(row["id"])
+                if sid not in ancora:
+                    self._rate.pop(sid, None)
+                    continue
+                self._inviati.add((sid, tipo, row["scadenza"].isoformat()))
+                promemoria.append(self._promemoria(tipo, row))
+
+        if promemoria and self.outbox_path:
+            self._scrivi_outbox(promemoria)
+        return promemoria
+
+    def scadute(self, oggi: date = None) -> list:
+        """Rate da pagare tracciate con scadenza passata (dalla memoria, senza query)."""
+        oggi = oggi or date.today()
+        with self._lock:
+            return sorted((r for r in self._rate.values() if r["scadenza"] < oggi), key=lambda r: r["scadenza"])
+
+    def in_scadenza(self, oggi: date = None) -> list:
+        """Rate da pagare tracciate che scadono entro il preavviso (dalla memoria)."""
+        oggi = oggi or date.today()
+        limite = oggi + self.preavviso
+        with self._lock:
+            return sorted((r for r in self._rate.values() if oggi <= r["scadenza"] <= limite), key=lambda r: r["scadenza"])
+
+    def run_forever(self, intervallo_s: float = 3600.0, on_promemoria=None):
+        """Ciclo bloccante per l'uso come processo separato (es. da cli.py)."""
+        while True:
+            promemoria = self.advance(date.today(), forza=True)
+            if on_promemoria and promemoria:
+                on_promemoria(promemoria)
+            time.sleep(intervallo_s)
+
+    # -----------------------------------------------------
+    # Outbox
+    # -----------------------------------------------------
+    @staticmethod
+    def _promemoria(tipo: str, row: dict) -> dict:
+        return {
+            "tipo": tipo,
+            "id": int(row["id"]),
+            "immobile": row.get("immobile"),
+            "esercizio": int(row["esercizio"]) if row.get("esercizio") is not None else None,
+            "numero_rata": row.get("numero_rata"),
+            "numero_rate_totali": row.get("numero_rate_totali"),
+            "scadenza": row["scadenza"].isoformat(),
+            "importo": float(row["importo"] or 0),
+            "creato": datetime.now().isoformat(timespec="seconds"),
+        }
+
+    def _leggi_outbox(self) -> set:
+        inviati = set()
+        if not os.path.exists(self.outbox_path):
+            return inviati
+        with open(self.outbox_path, encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    p = json.loads(line)
+                    inviati.add((int(p["id"]), p["tipo"], p["scadenza"]))
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return inviati
+
+    def _scrivi_outbox(self, promemoria: list):
+        with open(self.outbox_path, "a", encoding="utf-8") as fh:
+            for p in promemoria:
+                fh.write(json.dumps(p, ensure_ascii=False) + "\n")
@@ -0,0 +1,474 @@
+"""
+Logica di accesso ai dati (query e scritture) condivisa tra l'app Streamlit
+e la riga di comando. Non importa Streamlit né Plotly.
+"""
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+from psycopg2.extras import execute_values
+
+from db import get_conn
+from partitioning import ensure_partizioni, esercizi_presenti, is_partizionata
+
+STATI = ["Da pagare", "Pagato"]
+TIPI_SPESA = ["Ordinario", "Straordinario"]
+CATEGORIE_CASSA = ["Pagato", "Da pagare", "Scaduto"]
+GRANULARITA = ["month", "week"]
+
+# Stato del contatore modifiche: presenza della tabella (cache di processo)
+# e versione letta dall'ultima scrittura di ciascun thread (sessione Streamlit).
+_modifiche_verificata = None
+_scrittura = threading.local()
+
+# =========================================================
+# Helpers DB
+# =========================================================
+def df_query(sql: str, params=()):
+    with get_conn() as conn:
+        return pd.read_sql_query(sql, conn, params=params)
+
+def exec_sql(sql: str, params=()):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+        conn.commit()
+
+def exec_returning(sql: str, params=()):
+    """
+    Esegue una singola istruzione con RETURNING e restituisce la riga
+    modificata come dict (None se nessuna riga è stata toccata).
+    """
+    rows = exec_returning_all(sql, params)
+    return rows[0] if rows else None
+
+def exec_returning_all(sql: str, params=()) -> list:
+    """Come exec_returning, ma restituisce tutte le righe toccate."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall() if cur.description else []
+            cols = [d[0] for d in cur.description] if cur.description else []
+            # letta nella stessa transazione: include l'incremento di questa scrittura
+            _scrittura.versione = _leggi_versione(cur)
+        conn.commit()
+    return [dict(zip(cols, r)) for r in rows]
+
+def rows_query(sql: str, params=()) -> list:
+    """Lettura leggera (senza pandas): righe come lista di dict."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            cols = [d[0] for d in cur.description]
+            return [dict(zip(cols, r)) for r in cur.fetchall()]
+
+# =========================================================
+# SQL
+# =========================================================
+IMMOBILI_SQL = "SELECT id, nome, indirizzo, codice_fiscale, iban FROM immobili ORDER BY nome"
+
+SPESE_SQL = """
+    SELECT s.id, s.immobile_id, i.nome AS immobile, s.esercizio, s.numero_rata, s.numero_rate_totali, s.tipo_spesa,
+           s.scadenza, s.importo, s.note, s.stato, s.data_pagamento
+    FROM spese s
+    JOIN immobili i ON i.id = s.immobile_id
+"""
+
+SPESE_ORDER_BY = " ORDER BY s.scadenza ASC, i.nome ASC, s.esercizio ASC, s.numero_rata ASC"
+
+# Colonne restituite dalle UPDATE/DELETE su spese: stesse di SPESE_SQL,
+# così la riga può essere applicata direttamente ai DataFrame in cache.
+SPESE_RETURNING = """
+    RETURNING s.id, s.immobile_id, i.nome AS immobile, s.esercizio, s.numero_rata, s.numero_rate_totali, s.tipo_spesa,
+              s.scadenza, s.importo, s.note, s.stato, s.data_pagamento
+"""
+
+# Per gli UPDATE: anche i valori precedenti alla modifica (self-join su spese p,
+# letta con lo snapshot dell'istruzione), per spostare la rata tra i bucket
+# dei flussi di cassa senza dipendere da cosa c'è in cache. Vedi separa_prima.
+COLONNE_PRIMA = ("stato", "scadenza", "data_pagamento", "importo", "tipo_spesa")
+SPESE_RETURNING_PRIMA = SPESE_RETURNING.rstrip() + "".join(
+    f", p.{c} AS {c}_prima" for c in COLONNE_PRIMA
+) + "\n"
+
+# La nota extra (se presente) viene accodata nella stessa UPDATE del cambio stato.
+NOTE_APPEND_SQL = """
+    note = CASE
+        WHEN %(nota)s = '' THEN s.note
+        WHEN s.note IS NULL OR trim(s.note) = '' THEN %(nota)s
+        ELSE s.note || ' | ' || %(nota)s
+    END
+"""
+
+INSERT_SPESE_VALUES_SQL = """
+    INSERT INTO spese
+    (immobile_id, esercizio, scadenza, importo, note, stato, data_pagamento, numero_rata, numero_rate_totali, tipo_spesa)
+    VALUES %s
+"""
+
+def spese_where(immobile=None, stato=None, esercizio=None, ids=None, scadenza_dal=None, scadenza_al=None,
+                esercizi=None):
+    """
+    Costruisce la clausola WHERE (con parametri nominali) per i filtri
+    usati da elenco, esportazione e pagamenti massivi. None = nessun filtro.
+    """
+    where = " WHERE 1=1"
+    params = {}
+    if immobile is not None:
+        where += " AND i.nome=%(immobile)s"
+        params["immobile"] = immobile
+    if stato is not None:
+        where += " AND s.stato=%(stato)s"
+        params["stato"] = stato
+    if esercizio is not None:
+        where += " AND s.esercizio=%(esercizio)s"
+        params["esercizio"] = int(esercizio)
+    if esercizi is not None:
+        # predicato sulla chiave di partizione: legge solo le partizioni di quegli anni
+        where += " AND s.esercizio = ANY(%(esercizi)s)"
+        params["esercizi"] = [int(x) for x in esercizi]
+    if ids is not None:
+        where += " AND s.id = ANY(%(ids)s)"
+        params["ids"] = [int(x) for x in ids]
+    if scadenza_dal is not None:
+        where += " AND s.scadenza >= %(scad_dal)s"
+        params["scad_dal"] = scadenza_dal.isoformat()
+    if scadenza_al is not None:
+        where += " AND s.scadenza <= %(scad_al)s"
+        params["scad_al"] = scadenza_al.isoformat()
+    return where, params
+
+# =========================================================
+# Letture
+# =========================================================
+def get_immobili_df():
+    return df_query(IMMOBILI_SQL)
+
+def get_immobile_id(nome: str) -> int:
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM immobili WHERE nome=%s", (nome,))
+            row = cur.fetchone()
+            return int(row[0]) if row else None
+
+def list_spese(**filtri) -> pd.DataFrame:
+    """Rate (spese) con nome immobile, filtrate e ordinate per scadenza crescente."""
+    where, params = spese_where(**filtri)
+    return df_query(SPESE_SQL + where + SPESE_ORDER_BY, params)
+
+def rate_da_pagare(scadenza_al: date, scadenza_dopo: date = None, id_dopo: int = None) -> list:
+    """
+    Rate da pagare con scadenza <= scadenza_al (range sull'indice parziale
+    idx_spese_da_pagare_scadenza). Con scadenza_dopo/id_dopo restituisce solo
+    la finestra nuova (scadenza_dopo, scadenza_al] più le rate inserite dopo
+    id_dopo: è il caricamento incrementale usato dallo scheduler.
+    """
+    params = {"al": scadenza_al.isoformat()}
+    if scadenza_dopo is None:
+        return rows_query(SPESE_SQL + " WHERE s.stato = 'Da pagare' AND s.scadenza <= %(al)s", params)
+    params.update({"dopo": scadenza_dopo.isoformat(), "id_dopo": int(id_dopo or 0)})
+    return rows_query(
+        SPESE_SQL + " WHERE s.stato = 'Da pagare' AND s.scadenza > %(dopo)s AND s.scadenza <= %(al)s"
+        + " UNION "
+        + SPESE_SQL + " WHERE s.stato = 'Da pagare' AND s.id > %(id_dopo)s AND s.scadenza <= %(al)s",
+        params,
+    )
+
+def esercizi_disponibili() -> list:
+    """Anni (esercizi) con almeno una spesa, in ordine crescente."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            if is_partizionata(cur):
+                return esercizi_presenti(cur)
+            cur.execute("SELECT DISTINCT esercizio FROM spese WHERE esercizio IS NOT NULL ORDER BY 1")
+            return [int(r[0]) for r in cur.fetchall()]
+
+def n_spese_immobile(imm_id: int) -> int:
+    """Numero di spese collegate all'immobile (lettura live, per il blocco dell'eliminazione)."""
+    return int(rows_query("SELECT COUNT(*) AS n FROM spese WHERE immobile_id=%s", (int(imm_id),))[0]["n"])
+
+def _ha_modifiche(cur) -> bool:
+    """True se esiste la tabella modifiche (cli.py indici); l'assenza viene riverificata ogni 5 minuti."""
+    global _modifiche_verificata
+    if _modifiche_verificata is not None:
+        presente, quando = _modifiche_verificata
+        if presente or time.monotonic() - quando < 300:
+            return presente
+    cur.execute("SELECT to_regclass('public.modifiche') IS NOT NULL")
+    presente = bool(cur.fetchone()[0])
+    _modifiche_verificata = (presente, time.monotonic())
+    return presente
+
+def _leggi_versione(cur):
+    if not _ha_modifiche(cur):
+        return None
+    cur.execute("SELECT versione FROM modifiche WHERE id = 1")
+    row = cur.fetchone()
+    return int(row[0]) if row else None
+
+def versione_dati():
+    """
+    Contatore delle modifiche a spese e immobili (trigger per istruzione,
+    vedi db.ensure_modifiche): cambia a ogni scrittura, anche di altre
+    sessioni o della CLI. None se il contatore non è installato.
+    """
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            return _leggi_versione(cur)
+
+def ultima_versione_scritta():
+    """Versione del contatore subito dopo l'ultima exec_returning* di questo thread (None se ignota)."""
+    return getattr(_scrittura, "versione", None)
+
+def ids_ancora_da_pagare(ids) -> set:
+    """Sottoinsieme di `ids` ancora in stato Da pagare (verifica prima di un promemoria)."""
+    if not ids:
+        return set()
+    rows = rows_query("SELECT id FROM spese WHERE id = ANY(%s) AND stato = 'Da pagare'", ([int(x) for x in ids],))
+    return {int(r["id"]) for r in rows}
+
+def cashflow_buckets(granularita: str, oggi: date) -> dict:
+    """
+    Flussi di cassa per periodo (date_trunc mese/settimana), categoria
+    (Pagato / Da pagare / Scaduto) e tipo spesa: {(periodo, categoria, tipo): importo}.
+    Le rate pagate cadono nel periodo di data_pagamento, le altre in quello di scadenza.
+    """
+    if granularita not in GRANULARITA:
+        raise ValueError(f"granularità non valida: {granularita}")
+    rows = rows_query(
+        """
+        SELECT date_trunc(%(g)s, CASE WHEN s.stato = 'Pagato'
+                                      THEN COALESCE(s.data_pagamento::date, s.scadenza::date)
+                                      ELSE s.scadenza::date END)::date AS periodo,
+               CASE WHEN s.stato = 'Pagato' THEN 'Pagato'
+                    WHEN s.scadenza::date < %(oggi)s THEN 'Scaduto'
+                    ELSE 'Da pagare' END AS categoria,
+               s.tipo_spesa,
+               SUM(s.importo) AS importo
+        FROM spese s
+        WHERE s.scadenza IS NOT NULL
+        GROUP BY 1, 2, 3
+        """,
+        {"g": granularita, "oggi": oggi.isoformat()},
+    )
+    return {(r["periodo"], r["categoria"], r["tipo_spesa"]): float(r["importo"] or 0) for r in rows}
+
+def cashflow_key(row, granularita: str, oggi: date):
+    """Chiave del bucket di una singola rata: stessa regola di cashflow_buckets (None se senza scadenza)."""
+    scad = to_date(row["scadenza"])
+    if scad is None:
+        return None
+    if row["stato"] == "Pagato":
+        d = to_date(row["data_pagamento"]) or scad
+        categoria = "Pagato"
+    else:
+        d = scad
+        categoria = "Scaduto" if scad < oggi else "Da pagare"
+    if granularita == "month":
+        periodo = d.replace(day=1)
+    else:
+        periodo = d - timedelta(days=d.weekday())  # come date_trunc('week'): lunedì
+    return (periodo, categoria, row["tipo_spesa"])
+
+def separa_prima(row: dict):
+    """
+    Divide una riga restituita con SPESE_RETURNING_PRIMA in (dopo, prima):
+    `prima` è la stessa rata con i valori precedenti all'UPDATE, None se la
+    riga non li contiene (INSERT, DELETE).
+    """
+    dopo = {k: v for k, v in row.items() if not k.endswith("_prima")}
+    if not any(f"{c}_prima" in row for c in COLONNE_PRIMA):
+        return dopo, None
+    prima = dict(dopo, **{c: row[f"{c}_prima"] for c in COLONNE_PRIMA if f"{c}_prima" in row})
+    return dopo, prima
+
+def cashflow_delta(buckets: dict, granularita: str, oggi: date, prima=None, dopo=None):
+    """
+    Aggiorna in place i bucket di cashflow_buckets per una rata modificata:
+    toglie `prima` dal suo bucket e aggiunge `dopo` al proprio (None = assente,
+    es. inserimento o eliminazione).
+    """
+    for row, segno in ((prima, -1), (dopo, +1)):
+        if row is None:
+            continue
+        key = cashflow_key(row, granularita, oggi)
+        if key is None:
+            continue
+        buckets[key] = buckets.get(key, 0.0) + segno * float(row["importo"] or 0)
+        if abs(buckets[key]) < 1e-9:
+            del buckets[key]
+
+def riepilogo_scadenze(oggi: date, giorni: int = 30) -> pd.DataFrame:
+    """
+    Per ogni immobile: rate da pagare già scadute e in scadenza nei
+    prossimi `giorni` giorni (numero e importo).
+    """
+    limite = date.fromordinal(oggi.toordinal() + int(giorni))
+    return df_query(
+        """
+        SELECT i.nome AS immobile,
+               COUNT(*) FILTER (WHERE s.scadenza < %(oggi)s) AS n_scadute,
+               COALESCE(SUM(s.importo) FILTER (WHERE s.scadenza < %(oggi)s), 0) AS importo_scadute,
+               COUNT(*) FILTER (WHERE s.scadenza >= %(oggi)s AND s.scadenza <= %(limite)s) AS n_in_scadenza,
+               COALESCE(SUM(s.importo) FILTER (WHERE s.scadenza >= %(oggi)s AND s.scadenza <= %(limite)s), 0) AS importo_in_scadenza
+        FROM spese s
+        JOIN immobili i ON i.id = s.immobile_id
+        WHERE s.stato = 'Da pagare' AND s.scadenza <= %(limite)s
+        GROUP BY i.nome
+        ORDER BY i.nome
+        """,
+        {"oggi": oggi.isoformat(), "limite": limite.isoformat()},
+    )
+
+# =========================================================
+# Scritture
+# =========================================================
+def add_immobile(nome: str) -> dict:
+    """Inserisce un immobile; restituisce None se il nome esiste già."""
+    return exec_returning(
+        """
+        INSERT INTO immobili(nome) VALUES (%s) ON CONFLICT (nome) DO NOTHING
+        RETURNING id, nome, indirizzo, codice_fiscale, iban
+        """,
+        (nome,),
+    )
+
+def delete_immobile(imm_id: int):
+    exec_sql("DELETE FROM immobili WHERE id=%s", (imm_id,))
+
+def update_immobile(imm_id: int, nome: str, indirizzo, codice_fiscale, iban) -> dict:
+    return exec_returning(
+        """
+        UPDATE immobili SET nome=%s, indirizzo=%s, codice_fiscale=%s, iban=%s WHERE id=%s
+        RETURNING id, nome, indirizzo, codice_fiscale, iban
+        """,
+        (nome, indirizzo, codice_fiscale, iban, imm_id),
+    )
+
+def mark_spesa_pagata(spesa_id: int, data_pagamento: date, nota_extra: str = "") -> dict:
+    rows = mark_spese_pagate(data_pagamento, nota_extra, ids=[spesa_id])
+    return rows[0] if rows else None
+
+def mark_spese_pagate(data_pagamento: date, nota_extra: str = "", **filtri) -> list:
+    """
+    Segna come pagate, in una sola UPDATE, tutte le rate che soddisfano i
+    filtri (vedi spese_where). Restituisce le righe aggiornate.
+    """
+    where, params = spese_where(**filtri)
+    params.update({"dp": data_pagamento.isoformat(), "nota": (nota_extra or "").strip()})
+    return exec_returning_all(
+        "UPDATE spese s SET stato='Pagato', data_pagamento=%(dp)s, " + NOTE_APPEND_SQL + """
+        FROM immobili i, spese p
+        """ + where + " AND i.id = s.immobile_id AND p.id = s.id AND p.esercizio = s.esercizio" + SPESE_RETURNING_PRIMA,
+        params,
+    )
+
+def mark_spesa_da_pagare(spesa_id: int, nota_extra: str = "") -> dict:
+    return exec_returning(
+        "UPDATE spese s SET stato='Da pagare', data_pagamento=NULL, " + NOTE_APPEND_SQL + """
+        FROM immobili i, spese p
+        WHERE i.id = s.immobile_id AND s.id = %(id)s AND p.id = s.id AND p.esercizio = s.esercizio
+        """ + SPESE_RETURNING_PRIMA,
+        {"nota": (nota_extra or "").strip(), "id": spesa_id},
+    )
+
+def delete_spesa(spesa_id: int) -> dict:
+    return exec_returning(
+        "DELETE FROM spese s USING immobili i WHERE i.id = s.immobile_id AND s.id = %s" + SPESE_RETURNING,
+        (spesa_id,),
+    )
+
+def _rata_row(immobile_id, esercizio, tipo_spesa, nr, tot_rates, scadenza, importo,
+              note_base, stato, data_pagamento) -> tuple:
+    extra_desc = f"{tipo_spesa} | Esercizio {int(esercizio)} | Rata {int(nr)}/{int(tot_rates)}"
+    note_final = safe_note(note_base, extra_desc)
+    return (
+        int(immobile_id),
+        int(esercizio),
+        to_date(scadenza).isoformat(),
+        float(importo),
+        note_final if note_final else None,
+        stato,
+        (data_pagamento.isoformat() if (stato == "Pagato" and data_pagamento) else None),
+        int(nr),
+        int(tot_rates),
+        tipo_spesa
+    )
+
+def build_rate_rows(immobile_id: int, esercizio: int, tipo_spesa: str, rate, note_base: str = "",
+                    stato: str = "Da pagare", data_pagamento: date = None) -> list:
+    """
+    Prepara le tuple per insert_rate (INSERT_SPESE_VALUES_SQL) a partire da una lista di
+    (scadenza, importo). Le rate con importo <= 0 vengono saltate ma
+    mantengono la numerazione.
+    """
+    tot_rates = len(rate)
+    return [
+        _rata_row(immobile_id, esercizio, tipo_spesa, i + 1, tot_rates, scadenza, importo,
+                  note_base, stato, data_pagamento)
+        for i, (scadenza, importo) in enumerate(rate)
+        if float(importo) > 0
+    ]
+
+def build_piano_rows(piano: pd.DataFrame, note_base: str = "", stato: str = "Da pagare",
+                     data_pagamento: date = None) -> list:
+    """Come build_rate_rows, per un piano di piano_rate.genera_piano (anche modificato a mano)."""
+    piano = piano[pd.to_numeric(piano["importo"], errors="coerce").fillna(0) > 0]
+    return [
+        _rata_row(r.immobile_id, r.esercizio, r.tipo_spesa, r.numero_rata, r.numero_rate_totali,
+                  r.scadenza, r.importo, note_base, stato, data_pagamento)
+        for r in piano.itertuples(index=False)
+    ]
+
+def insert_rate(rows: list):
+    """Inserisce tutte le rate con un'unica INSERT multi-riga (execute_values)."""
+    if not rows:
+        return
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            # Con spese partizionata per esercizio, crea prima (nella stessa
+            # transazione) le partizioni degli anni nuovi
+            ensure_partizioni({r[1] for r in rows}, cur)
+            execute_values(cur, INSERT_SPESE_VALUES_SQL, rows, page_size=1000)
+        conn.commit()
+
+# =========================================================
+# Helpers di formattazione
+# =========================================================
+def safe_note(base_note: str, extra: str) -> str:
+    base_note = "" if base_note is None else str(base_note).strip()
+    extra = "" if extra is None else str(extra).strip()
+    if base_note and extra:
+        return base_note + " | " + extra
+    return base_note or extra
+
+def to_date(value) -> date:
+    """Normalizza date/datetime/stringa ISO (anche da pandas) in date; None se vuoto."""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None  # anche NaT, che è un'istanza di datetime
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if not str(value).strip():
+        return None
+    return date.fromisoformat(str(value)[:10])
+
+def euro(x) -> str:
+    try:
+        return f"€ {float(x):,.2f}"
+    except Exception:
+        return "€ 0,00"
+
+def compute_rata_display(df: pd.DataFrame) -> pd.Series:
+    """
+    Usa SEMPRE numero_rate_totali dal DB (colonna aggiunta),
+    fallback a 1 se non valorizzato.
+    """
+    if df.empty:
+        return pd.Series([], dtype="string")
+    nr = pd.to_numeric(df.get("numero_rata"), errors="coerce").fillna(1).astype(int)
+    tot = pd.to_numeric(df.get("numero_rate_totali"), errors="coerce").fillna(1).astype(int)
+    tot = tot.where(tot >= 1, 1)
+    return nr.astype(str) + "/" + tot.astype(str)
@@ -0,0 +1,87 @@
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from service import cashflow_delta, cashflow_key, separa_prima, to_date
+
+OGGI = date(2025, 3, 10)
+
+
+def rata(scadenza, stato="Da pagare", data_pagamento=None, tipo="Ordinario"):
+    return {"scadenza": scadenza, "stato": stato, "data_pagamento": data_pagamento, "tipo_spesa": tipo}
+
+
+def date_trunc_week(d: date) -> date:
+    # date_trunc('week') di PostgreSQL: lunedì della settimana ISO
+    return pd.Timestamp(d).to_period("W-SUN").start_time.date()
+
+
+@pytest.mark.parametrize("giorno", [date(2024, 12, 29) + timedelta(days=i) for i in range(14)])
+def test_settimana_come_date_trunc_week(giorno):
+    periodo, _, _ = cashflow_key(rata(giorno), "week", OGGI)
+    assert periodo == date_trunc_week(giorno)
+    assert periodo.weekday() == 0
+
+
+def test_settimana_a_cavallo_d_anno():
+    # domenica 5/1/2025 e martedì 31/12/2024 cadono nella settimana di lunedì 30/12/2024
+    assert cashflow_key(rata(date(2025, 1, 5)), "week", OGGI)[0] == date(2024, 12, 30)
+    assert cashflow_key(rata(date(2024, 12, 31)), "week", OGGI)[0] == date(2024, 12, 30)
+
+
+def test_mese_e_categorie():
+    assert cashflow_key(rata(date(2025, 3, 31)), "month", OGGI) == (date(2025, 3, 1), "Da pagare", "Ordinario")
+    assert cashflow_key(rata(date(2025, 3, 9)), "month", OGGI) == (date(2025, 3, 1), "Scaduto", "Ordinario")
+    # le pagate cadono nel periodo di data_pagamento
+    pagata = rata(date(2025, 3, 9), stato="Pagato", data_pagamento=datetime(2025, 2, 27, 10, 30), tipo="Straordinario")
+    assert cashflow_key(pagata, "month", OGGI) == (date(2025, 2, 1), "Pagato", "Straordinario")
+    # pagata senza data: scadenza
+    assert cashflow_key(rata(date(2025, 1, 15), stato="Pagato"), "month", OGGI)[0] == date(2025, 1, 1)
+
+
+def test_senza_scadenza():
+    assert cashflow_key(rata(None), "month", OGGI) is None
+    assert cashflow_key(rata(pd.NaT), "week", OGGI) is None
+
+
+def test_delta_rata_fuori_dagli_anni_in_cache():
+    # rata del 2019 (non tra gli esercizi caricati dalla Dashboard) pagata oggi:
+    # il "prima" arriva dalla scrittura, non dal frame della Dashboard
+    scritta = dict(rata(date(2019, 6, 30), stato="Pagato", data_pagamento=date(2025, 3, 10)),
+                   id=7, esercizio=2019, importo=100.0,
+                   stato_prima="Da pagare", scadenza_prima=date(2019, 6, 30), data_pagamento_prima=None,
+                   importo_prima=100.0, tipo_spesa_prima="Ordinario")
+    dopo, prima = separa_prima(scritta)
+    assert not any(k.endswith("_prima") for k in dopo)
+    assert prima["stato"] == "Da pagare" and prima["data_pagamento"] is None
+
+    vecchio = (date(2019, 6, 1), "Scaduto", "Ordinario")
+    nuovo = (date(2025, 3, 1), "Pagato", "Ordinario")
+    buckets = {vecchio: 250.0}
+    cashflow_delta(buckets, "month", OGGI, prima, dopo)
+    assert buckets == {vecchio: 150.0, nuovo: 100.0}
+
+    # eliminazione: l'importo esce dal bucket senza contarla due volte
+    cashflow_delta(buckets, "month", OGGI, prima=dopo)
+    assert buckets == {vecchio: 150.0}
+
+
+def test_separa_prima_senza_valori_precedenti():
+    riga = dict(rata(date(2025, 4, 1)), id=1, importo=10.0)
+    assert separa_prima(riga) == (riga, None)
+
+
+@pytest.mark.parametrize("valore, atteso", [
+    (None, None),
+    (pd.NaT, None),
+    (float("nan"), None),
+    ("", None),
+    ("2025-03-10", date(2025, 3, 10)),
+    ("2025-03-10T08:00:00", date(2025, 3, 10)),
+    (datetime(2025, 3, 10, 23, 59), date(2025, 3, 10)),
+    (pd.Timestamp("2025-03-10 12:00"), date(2025, 3, 10)),
+    (date(2025, 3, 10), date(2025, 3, 10)),
+])
+def test_to_date(valore, atteso):
+    assert to_date(valore) == atteso
@@ -0,0 +1,28 @@
+import argparse
+from datetime import date
+
+import pytest
+
+from cli import parse_ids, parse_rata
+
+
+def test_parse_ids():
+    assert parse_ids("3,7-10") == [3, 7, 8, 9, 10]
+    assert parse_ids(" 5 , 12-12 ,") == [5, 12]
+
+
+@pytest.mark.parametrize("valore", ["14-10", "", " , ", "a-3", "3-", "1,x"])
+def test_parse_ids_non_valido(valore):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_ids(valore)
+
+
+def test_parse_rata():
+    assert parse_rata("2026-03-31:250") == (date(2026, 3, 31), 250.0)
+    assert parse_rata("2026-03-31:99.5") == (date(2026, 3, 31), 99.5)
+
+
+@pytest.mark.parametrize("valore", ["2026-03-31", "31/03/2026:250", "2026-03-31:dieci"])
+def test_parse_rata_non_valida(valore):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_rata(valore)
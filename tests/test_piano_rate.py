@@ -0,0 +1,44 @@
+from datetime import date
+
+import pytest
+
+from piano_rate import COLONNE_PIANO, genera_piano
+
+IMMOBILI = [(1, "Via Roma"), (2, "Via Milano")]
+
+
+def test_resto_sull_ultima_rata():
+    piano = genera_piano(IMMOBILI[:1], [2025], 100.0, 3, date(2025, 1, 15))
+    assert piano["importo"].tolist() == [33.33, 33.33, 33.34]
+    assert round(piano["importo"].sum(), 2) == 100.0
+    assert piano["numero_rata"].tolist() == [1, 2, 3]
+    assert (piano["numero_rate_totali"] == 3).all()
+
+
+def test_fine_mese_limitata():
+    piano = genera_piano(IMMOBILI[:1], [2024], 120.0, 4, date(2024, 1, 31), frequenza="Mensile")
+    # 2024 bisestile: 29 febbraio; aprile ha 30 giorni
+    assert piano["scadenza"].tolist() == [date(2024, 1, 31), date(2024, 2, 29), date(2024, 3, 31), date(2024, 4, 30)]
+
+
+def test_frequenza_e_cambio_anno():
+    piano = genera_piano(IMMOBILI[:1], [2025], 400.0, 4, date(2025, 11, 30), frequenza="Trimestrale")
+    assert piano["scadenza"].tolist() == [date(2025, 11, 30), date(2026, 2, 28), date(2026, 5, 30), date(2026, 8, 30)]
+
+
+def test_piu_immobili_ed_esercizi():
+    piano = genera_piano(IMMOBILI, [2026, 2025], 200.0, 2, date(2025, 3, 1), frequenza="Semestrale")
+    assert list(piano.columns) == COLONNE_PIANO
+    assert len(piano) == 2 * 2 * 2
+    # gli altri esercizi si spostano dello stesso numero di anni
+    s2026 = piano[(piano["immobile_id"] == 2) & (piano["esercizio"] == 2026)]
+    assert s2026["scadenza"].tolist() == [date(2026, 3, 1), date(2026, 9, 1)]
+    assert set(piano["immobile"]) == {"Via Roma", "Via Milano"}
+
+
+def test_casi_limite():
+    assert genera_piano([], [2025], 100.0, 2, date(2025, 1, 1)).empty
+    with pytest.raises(ValueError):
+        genera_piano(IMMOBILI, [2025], 100.0, 0, date(2025, 1, 1))
+    with pytest.raises(ValueError):
+        genera_piano(IMMOBILI, [2025], 100.0, 2, date(2025, 1, 1), frequenza="Settimanale")
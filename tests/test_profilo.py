@@ -0,0 +1,36 @@
+import threading
+
+import pytest
+
+import profilo
+
+
+@pytest.fixture
+def prof(monkeypatch):
+    monkeypatch.setattr(profilo, "ATTIVO", True)
+    monkeypatch.setattr(profilo, "_thread", None)
+    monkeypatch.setattr(profilo, "_passi", [])
+    monkeypatch.setattr(profilo, "_chiuso", False)
+    return profilo
+
+
+def test_stampa_solo_il_primo_run(prof, capsys):
+    prof.segna("import")
+    prof.segna("fine script")
+    prof.chiudi()
+    # run successivi dello script nello stesso processo
+    prof.segna("fine script")
+    prof.chiudi()
+
+    righe = [r for r in capsys.readouterr().err.splitlines() if r.startswith("[profilo]")]
+    assert len(righe) == 1
+    assert [p for p, _, _ in prof.passi()] == ["import", "fine script"]
+
+
+def test_altre_sessioni_ignorate(prof):
+    prof.segna("primo run")
+    altra = threading.Thread(target=lambda: (prof.segna("altra sessione"), prof.chiudi()))
+    altra.start()
+    altra.join()
+    assert [p for p, _, _ in prof.passi()] == ["primo run"]
+    assert not prof._chiuso
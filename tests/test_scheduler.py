@@ -0,0 +1,178 @@
+from datetime import date, timedelta
+
+import pytest
+
+import scheduler
+from scheduler import IN_SCADENZA, SCADUTA, ScadenzeScheduler
+
+OGGI = date(2025, 3, 10)
+
+
+class FakeSpese:
+    """Tabella spese in memoria con le letture usate dallo scheduler e il contatore modifiche."""
+
+    def __init__(self, *rate):
+        self.rows = {r["id"]: r for r in rate}
+        self.versione = None  # None = contatore non installato
+        self.query = 0
+        self.riletture = 0
+
+    def modifica(self):
+        """Scrittura di un altro processo: il trigger fa avanzare il contatore."""
+        if self.versione is not None:
+            self.versione += 1
+
+    def versione_dati(self):
+        return self.versione
+
+    def rate_da_pagare(self, scadenza_al, scadenza_dopo=None, id_dopo=None):
+        self.query += 1
+        self.riletture += scadenza_dopo is None
+        return [
+            dict(r) for r in self.rows.values()
+            if r["stato"] == "Da pagare" and r["scadenza"] <= scadenza_al
+            and (scadenza_dopo is None or r["scadenza"] > scadenza_dopo or r["id"] > id_dopo)
+        ]
+
+    def ids_ancora_da_pagare(self, ids):
+        self.query += 1
+        return {i for i in ids if i in self.rows and self.rows[i]["stato"] == "Da pagare"}
+
+
+def rata(sid, scadenza, stato="Da pagare"):
+    return {
+        "id": sid, "immobile": "Via Roma", "esercizio": scadenza.year, "numero_rata": 1,
+        "numero_rate_totali": 4, "scadenza": scadenza, "importo": 100.0, "stato": stato,
+    }
+
+
+@pytest.fixture
+def spese(monkeypatch):
+    db = FakeSpese()
+    monkeypatch.setattr(scheduler.service, "rate_da_pagare", db.rate_da_pagare)
+    monkeypatch.setattr(scheduler.service, "ids_ancora_da_pagare", db.ids_ancora_da_pagare)
+    monkeypatch.setattr(scheduler.service, "versione_dati", db.versione_dati)
+    return db
+
+
+def test_promemoria_una_sola_volta(spese):
+    spese.rows = {1: rata(1, OGGI - timedelta(days=3)), 2: rata(2, OGGI + timedelta(days=2))}
+    s = ScadenzeScheduler(preavviso_giorni=7, min_intervallo_s=0)
+
+    primi = s.advance(OGGI)
+    assert sorted((p["id"], p["tipo"]) for p in primi) == [(1, SCADUTA), (2, IN_SCADENZA)]
+    assert s.advance(OGGI) == []
+
+    # Alla scadenza della rata 2 arriva solo l'avviso "scaduta"
+    dopo = s.advance(OGGI + timedelta(days=3))
+    assert [(p["id"], p["tipo"]) for p in dopo] == [(2, SCADUTA)]
+
+
+def test_outbox_evita_duplicati_dopo_riavvio(spese, tmp_path):
+    spese.rows = {1: rata(1, OGGI - timedelta(days=1))}
+    outbox = str(tmp_path / "promemoria.jsonl")
+
+    assert len(ScadenzeScheduler(outbox_path=outbox).advance(OGGI)) == 1
+    assert ScadenzeScheduler(outbox_path=outbox).advance(OGGI) == []
+
+
+def test_rata_pagata_altrove_non_notificata(spese):
+    spese.rows = {1: rata(1, OGGI + timedelta(days=20))}
+    s = ScadenzeScheduler(preavviso_giorni=7, min_intervallo_s=3600)
+    assert s.advance(OGGI) == []
+
+    # Pagata dalla CLI prima del preavviso: la verifica dei candidati la scarta
+    spese.rows[1]["stato"] = "Pagato"
+    assert s.advance(OGGI + timedelta(days=15)) == []
+    assert s.in_scadenza(OGGI + timedelta(days=15)) == []
+
+
+def test_ricarica_allinea_rate_pagate_e_riaperte_altrove(spese):
+    spese.versione = 1
+    spese.rows = {i: rata(i, OGGI - timedelta(days=i)) for i in range(1, 4)}
+    s = ScadenzeScheduler(min_intervallo_s=0)
+    assert len(s.advance(OGGI)) == 3
+    assert len(s.scadute(OGGI)) == 3
+
+    # Pagate da un altro processo dopo l'avviso: escono dal banner alla ricarica
+    for i in (1, 2):
+        spese.rows[i]["stato"] = "Pagato"
+    spese.modifica()
+    s.advance(OGGI)
+    assert [r["id"] for r in s.scadute(OGGI)] == [3]
+
+    # Riaperta altrove: rientra, senza un secondo avviso
+    spese.rows[1]["stato"] = "Da pagare"
+    spese.modifica()
+    assert s.advance(OGGI) == []
+    assert sorted(r["id"] for r in s.scadute(OGGI)) == [1, 3]
+
+
+def test_ricarica_senza_modifiche_non_interroga(spese):
+    spese.versione = 1
+    spese.rows = {1: rata(1, OGGI - timedelta(days=1))}
+    s = ScadenzeScheduler(min_intervallo_s=0)
+    s.advance(OGGI)
+    query = spese.query
+    s.advance(OGGI)
+    s.advance(OGGI)
+    assert spese.query == query
+
+    # Giorno nuovo: solo la finestra incrementale, nessuna rilettura
+    s.advance(OGGI + timedelta(days=1))
+    assert spese.query == query + 1 and spese.riletture == 1
+
+
+def test_ricarica_incrementale_senza_contatore(spese):
+    spese.rows = {1: rata(1, OGGI + timedelta(days=30))}
+    s = ScadenzeScheduler(orizzonte_giorni=60, min_intervallo_s=0)
+    s.advance(OGGI)
+
+    # Rata inserita da un altro processo: arriva con id > ultimo id visto
+    spese.rows[2] = rata(2, OGGI + timedelta(days=3))
+    s.advance(OGGI)
+    assert [r["id"] for r in s.in_scadenza(OGGI)] == [2]
+    assert spese.riletture == 1
+
+
+def test_scrittura_propria_non_provoca_rilettura(spese):
+    spese.versione = 5
+    spese.rows = {1: rata(1, OGGI - timedelta(days=1))}
+    s = ScadenzeScheduler(min_intervallo_s=0)
+    s.advance(OGGI)
+
+    # Pagata dall'app: update() con la versione prodotta dalla scrittura
+    spese.rows[1]["stato"] = "Pagato"
+    spese.modifica()
+    s.update(dict(spese.rows[1]), versione=6)
+    s.advance(OGGI)
+    assert s.scadute(OGGI) == []
+    assert spese.riletture == 1
+
+    # Scrittura di un altro processo nel frattempo: la versione non è la successiva
+    spese.modifica()
+    spese.modifica()
+    s.update(rata(1, OGGI - timedelta(days=1)), versione=8)
+    s.advance(OGGI)
+    assert spese.riletture == 2
+    assert s.scadute(OGGI) == []
+
+
+def test_ricarica_limitata_da_min_intervallo(spese):
+    spese.rows = {1: rata(1, OGGI - timedelta(days=1))}
+    s = ScadenzeScheduler(min_intervallo_s=3600)
+    s.advance(OGGI)
+    query = spese.query
+    s.advance(OGGI)
+    assert spese.query == query
+
+
+def test_update_da_returning(spese):
+    s = ScadenzeScheduler(min_intervallo_s=3600)
+    s.precarica(OGGI)
+    assert s.pronto
+
+    s.update(rata(7, OGGI + timedelta(days=1)))
+    assert [r["id"] for r in s.in_scadenza(OGGI)] == [7]
+    s.update(rata(7, OGGI + timedelta(days=1), stato="Pagato"))
+    assert s.in_scadenza(OGGI) == []